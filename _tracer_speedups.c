@@ -0,0 +1,879 @@
+/*
+ * Optional accelerator for FunctionTracer's 'profile' engine.
+ *
+ * ProfileHook is a Py_tracefunc installed with PyEval_SetProfile(). Most
+ * profiler events belong to functions that are not traced; the hook drops
+ * those in C, after one lookup of the frame's code object in the tracer's
+ * code index (or of the called built-in in its set of traced built-ins),
+ * without calling into Python.
+ *
+ * Given the tracer, the hook also handles the common events of traced
+ * functions itself: it pushes the stack entry of a call, and on a normal
+ * return pops it and updates the stats, call path, caller entry and call
+ * edge, the same way FunctionTracer._push_call() and _pop_call() do. Every
+ * other event (generators and coroutines, exceptions, built-ins, stale
+ * entries, entries not created yet, the overhead governor, timeline and
+ * event log) is forwarded to the tracer's pure-Python profile function.
+ *
+ * Build with `python setup.py build_ext --inplace`. tracer.py falls back to
+ * sys.setprofile() when this module is not available.
+ */
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#if PY_VERSION_HEX < 0x030B0000
+#include <frameobject.h>
+#endif
+
+/* Event names passed to the profile function, indexed by PyTrace_* */
+static const char *const event_names[] = {
+    "call", "exception", "line", "return", "c_call", "c_exception", "c_return",
+};
+#define EVENT_COUNT ((int)(sizeof(event_names) / sizeof(event_names[0])))
+static PyObject *event_strings[EVENT_COUNT];
+
+/* Code of generators and coroutines, whose calls are left to the tracer */
+#define SUSPENDABLE_FLAGS (CO_GENERATOR | CO_COROUTINE | CO_ASYNC_GENERATOR)
+
+/* Stack entry layout, see _ThreadState in tracer.py */
+enum {
+    ENTRY_KEY, ENTRY_STATS, ENTRY_START, ENTRY_CHILD_NS, ENTRY_NESTED_NS,
+    ENTRY_NODE, ENTRY_PATH, ENTRY_INVOCATION, ENTRY_ERROR, ENTRY_SIZE,
+};
+
+/* LatencyHistogram layout, see tracer.py */
+#define SUB_BUCKET_BITS 4
+
+/* Attribute names, interned at import */
+static PyObject *str_enabled, *str_local, *str_stack, *str_stats, *str_paths, *str_edges,
+    *str_children, *str_call_count, *str_timed_count, *str_sample_rate, *str_total_ns,
+    *str_self_ns, *str_min_ns, *str_max_ns, *str_histogram, *str_counts, *str_record,
+    *str_sketch, *str_add, *str_hook_overhead_ns, *str_hidden_overhead_ns,
+    *str_overhead_budget, *str_timeline, *str_event_log, *str_f_lasti, *str_co_code, *str_dict;
+
+#if PY_VERSION_HEX < 0x030D0000
+static PyObject *perf_counter_ns;  /* time.perf_counter_ns */
+#endif
+
+/* Opcodes of a normal return, RETURN_VALUE and RETURN_CONST (3.12+) */
+static int return_ops[2] = {-1, -1};
+
+typedef struct {
+    PyObject_HEAD
+    PyObject *callback;    /* profile function(frame, event, arg) */
+    PyObject *code_index;  /* dict: code object -> traced function */
+    PyObject *builtins;    /* set of traced built-in functions */
+    PyObject *tracer;      /* FunctionTracer whose state the hook updates, or NULL */
+} ProfileHookObject;
+
+/* Same clock as time.perf_counter_ns(), which the tracer reads elsewhere */
+static int
+read_clock(long long *result)
+{
+#if PY_VERSION_HEX >= 0x030D0000
+    PyTime_t now;
+    if (PyTime_PerfCounterRaw(&now) < 0) {
+        return -1;
+    }
+    *result = (long long)now;
+    return 0;
+#else
+    PyObject *now = PyObject_CallNoArgs(perf_counter_ns);
+    if (now == NULL) {
+        return -1;
+    }
+    *result = PyLong_AsLongLong(now);
+    Py_DECREF(now);
+    return (*result == -1 && PyErr_Occurred()) ? -1 : 0;
+#endif
+}
+
+static int
+get_int(PyObject *obj, PyObject *name, long long *result)
+{
+    PyObject *value = PyObject_GetAttr(obj, name);
+    if (value == NULL) {
+        return -1;
+    }
+    *result = PyLong_AsLongLong(value);
+    Py_DECREF(value);
+    return (*result == -1 && PyErr_Occurred()) ? -1 : 0;
+}
+
+static int
+set_int(PyObject *obj, PyObject *name, long long value)
+{
+    PyObject *number = PyLong_FromLongLong(value);
+    if (number == NULL) {
+        return -1;
+    }
+    int result = PyObject_SetAttr(obj, name, number);
+    Py_DECREF(number);
+    return result;
+}
+
+static int
+add_int(PyObject *obj, PyObject *name, long long delta)
+{
+    long long value;
+    if (get_int(obj, name, &value) < 0) {
+        return -1;
+    }
+    return set_int(obj, name, value + delta);
+}
+
+static int
+get_item_int(PyObject *list, Py_ssize_t index, long long *result)
+{
+    *result = PyLong_AsLongLong(PyList_GET_ITEM(list, index));
+    return (*result == -1 && PyErr_Occurred()) ? -1 : 0;
+}
+
+static int
+add_item_int(PyObject *list, Py_ssize_t index, long long delta)
+{
+    long long value;
+    if (get_item_int(list, index, &value) < 0) {
+        return -1;
+    }
+    PyObject *number = PyLong_FromLongLong(value + delta);
+    if (number == NULL) {
+        return -1;
+    }
+    return PyList_SetItem(list, index, number);
+}
+
+/* Integer attribute of the tracer, looked up in its instance dict */
+static int
+get_setting(PyObject *settings, PyObject *name, long long *result)
+{
+    PyObject *value = PyDict_GetItemWithError(settings, name);
+    if (value == NULL) {
+        if (!PyErr_Occurred()) {
+            PyErr_SetObject(PyExc_AttributeError, name);
+        }
+        return -1;
+    }
+    *result = PyLong_AsLongLong(value);
+    return (*result == -1 && PyErr_Occurred()) ? -1 : 0;
+}
+
+/*
+ * Whether a frame whose return value is None is unwinding on an exception,
+ * from the instruction it stopped at, see FunctionTracer._unwinding_error().
+ */
+static int
+is_unwinding(PyFrameObject *frame, PyCodeObject *code)
+{
+    long long offset;
+    if (get_int((PyObject *)frame, str_f_lasti, &offset) < 0) {
+        return -1;
+    }
+    if (offset < 0) {
+        return 0;
+    }
+    PyObject *co_code = PyObject_GetAttr((PyObject *)code, str_co_code);
+    if (co_code == NULL) {
+        return -1;
+    }
+    int result = 1;
+    if (PyBytes_Check(co_code) && offset < PyBytes_GET_SIZE(co_code)) {
+        int op = (unsigned char)PyBytes_AS_STRING(co_code)[offset];
+        result = op != return_ops[0] && op != return_ops[1];
+    }
+    Py_DECREF(co_code);
+    return result;
+}
+
+/* LatencyHistogram.record(), in C while the buckets exist and do not overflow */
+static int
+record_histogram(PyObject *stats, long long duration)
+{
+    PyObject *histogram = PyObject_GetAttr(stats, str_histogram);
+    if (histogram == NULL) {
+        return -1;
+    }
+    PyObject *counts = PyObject_GetAttr(histogram, str_counts);
+    if (counts == NULL) {
+        Py_DECREF(histogram);
+        return -1;
+    }
+
+    int recorded = 0;
+    Py_buffer view;
+    if (counts != Py_None && PyObject_GetBuffer(counts, &view, PyBUF_WRITABLE) == 0) {
+        Py_ssize_t buckets = view.len / view.itemsize;
+        unsigned long long value = (unsigned long long)duration;
+        int bits = 0;
+        while (bits < 64 && (value >> bits) != 0) {
+            bits++;
+        }
+        int shift = bits - SUB_BUCKET_BITS - 1;
+        Py_ssize_t index = shift < 0 ? (Py_ssize_t)value
+                                     : (Py_ssize_t)((shift << SUB_BUCKET_BITS) + (value >> shift));
+        if (index >= buckets) {
+            index = buckets - 1;
+        }
+        if (view.itemsize == 4) {
+            uint32_t *bucket = (uint32_t *)view.buf + index;
+            if (*bucket != UINT32_MAX) {
+                ++*bucket;
+                recorded = 1;
+            }
+        }
+        else if (view.itemsize == 8) {
+            ++((uint64_t *)view.buf)[index];
+            recorded = 1;
+        }
+        PyBuffer_Release(&view);
+    }
+    else {
+        PyErr_Clear();
+    }
+    Py_DECREF(counts);
+
+    int result = 0;
+    if (!recorded) {
+        /* Allocates the buckets, or widens them */
+        PyObject *number = PyLong_FromLongLong(duration);
+        PyObject *returned = number != NULL ? PyObject_CallMethodOneArg(histogram, str_record, number) : NULL;
+        Py_XDECREF(number);
+        if (returned == NULL) {
+            result = -1;
+        }
+        Py_XDECREF(returned);
+    }
+    Py_DECREF(histogram);
+    return result;
+}
+
+/*
+ * FunctionTracer._push_call() for a traced call.
+ * Returns 1 if handled, 0 to forward the event, -1 on error.
+ */
+static int
+fast_call(ProfileHookObject *self, PyObject *state, PyFrameObject *frame, PyCodeObject *code)
+{
+    int result = 0;
+    PyObject *parent_path = NULL, *children = NULL, *entry = NULL;
+
+    PyObject *func = PyDict_GetItemWithError(self->code_index, (PyObject *)code);
+    if (func == NULL || (code->co_flags & SUSPENDABLE_FLAGS)) {
+        return PyErr_Occurred() ? -1 : 0;
+    }
+    PyObject *stack = PyDict_GetItemWithError(state, str_stack);
+    PyObject *stats_dict = PyDict_GetItemWithError(state, str_stats);
+    if (stack == NULL || stats_dict == NULL || !PyList_CheckExact(stack) || !PyDict_Check(stats_dict)) {
+        return PyErr_Occurred() ? -1 : 0;
+    }
+    /* Entries that do not exist yet are created by the tracer */
+    PyObject *stats = PyDict_GetItemWithError(stats_dict, func);
+    if (stats == NULL) {
+        result = PyErr_Occurred() ? -1 : 0;
+        goto done;
+    }
+    Py_ssize_t depth = PyList_GET_SIZE(stack);
+    if (depth > 0) {
+        PyObject *parent = PyList_GET_ITEM(stack, depth - 1);
+        if (!PyList_CheckExact(parent) || PyList_GET_SIZE(parent) != ENTRY_SIZE) {
+            goto done;
+        }
+        parent_path = Py_NewRef(PyList_GET_ITEM(parent, ENTRY_PATH));
+    }
+    else {
+        parent_path = PyDict_GetItemWithError(state, str_paths);
+        if (parent_path == NULL) {
+            result = PyErr_Occurred() ? -1 : 0;
+            goto done;
+        }
+        Py_INCREF(parent_path);
+    }
+    children = PyObject_GetAttr(parent_path, str_children);
+    if (children == NULL) {
+        result = -1;
+        goto done;
+    }
+    PyObject *path = PyDict_Check(children) ? PyDict_GetItemWithError(children, (PyObject *)code) : NULL;
+    if (path == NULL) {
+        result = PyErr_Occurred() ? -1 : 0;
+        goto done;
+    }
+
+    long long call_count, sample_rate, start_time = 0;
+    if (get_int(stats, str_call_count, &call_count) < 0
+        || get_int(stats, str_sample_rate, &sample_rate) < 0
+        || set_int(stats, str_call_count, ++call_count) < 0) {
+        result = -1;
+        goto done;
+    }
+    /* Not sampled, but its return must still find its entry */
+    int sampled = sample_rate > 0 && call_count % sample_rate == 0;
+
+    entry = PyList_New(ENTRY_SIZE);
+    if (entry == NULL) {
+        result = -1;
+        goto done;
+    }
+    PyList_SET_ITEM(entry, ENTRY_KEY, Py_NewRef((PyObject *)frame));
+    PyList_SET_ITEM(entry, ENTRY_STATS, Py_NewRef(sampled ? stats : Py_None));
+    PyList_SET_ITEM(entry, ENTRY_CHILD_NS, PyLong_FromLong(0));
+    PyList_SET_ITEM(entry, ENTRY_NESTED_NS, PyLong_FromLong(0));
+    PyList_SET_ITEM(entry, ENTRY_NODE, Py_NewRef((PyObject *)code));
+    PyList_SET_ITEM(entry, ENTRY_PATH, Py_NewRef(path));
+    PyList_SET_ITEM(entry, ENTRY_INVOCATION, Py_NewRef(Py_None));
+    PyList_SET_ITEM(entry, ENTRY_ERROR, Py_NewRef(Py_None));
+    if (sampled && read_clock(&start_time) < 0) {
+        result = -1;
+        goto done;
+    }
+    PyList_SET_ITEM(entry, ENTRY_START, PyLong_FromLongLong(start_time));
+    if (PyList_GET_ITEM(entry, ENTRY_START) == NULL || PyList_GET_ITEM(entry, ENTRY_CHILD_NS) == NULL
+        || PyList_GET_ITEM(entry, ENTRY_NESTED_NS) == NULL || PyList_Append(stack, entry) < 0) {
+        result = -1;
+        goto done;
+    }
+    result = 1;
+
+done:
+    Py_XDECREF(entry);
+    Py_XDECREF(children);
+    Py_XDECREF(parent_path);
+    return result;
+}
+
+/*
+ * FunctionTracer._pop_call() for a traced call returning normally from the
+ * top entry.
+ * Returns 1 if handled, 0 to forward the event, -1 on error.
+ */
+static int
+fast_return(PyObject *settings, PyObject *state, PyFrameObject *frame, PyCodeObject *code,
+            PyObject *arg)
+{
+    int result = 0;
+    PyObject *entry = NULL, *edge = NULL;
+
+    PyObject *stack = PyDict_GetItemWithError(state, str_stack);
+    if (stack == NULL || !PyList_CheckExact(stack)) {
+        return PyErr_Occurred() ? -1 : 0;
+    }
+    Py_ssize_t depth = PyList_GET_SIZE(stack);
+    if (depth == 0) {
+        return 0;
+    }
+    entry = Py_NewRef(PyList_GET_ITEM(stack, depth - 1));
+    if (!PyList_CheckExact(entry) || PyList_GET_SIZE(entry) != ENTRY_SIZE
+        || PyList_GET_ITEM(entry, ENTRY_KEY) != (PyObject *)frame
+        || PyList_GET_ITEM(entry, ENTRY_INVOCATION) != Py_None) {
+        goto done;
+    }
+    PyObject *stats = PyList_GET_ITEM(entry, ENTRY_STATS);
+    PyObject *parent = depth > 1 ? PyList_GET_ITEM(stack, depth - 2) : NULL;
+    if (parent != NULL && (!PyList_CheckExact(parent) || PyList_GET_SIZE(parent) != ENTRY_SIZE)) {
+        goto done;
+    }
+    long long start_time, child_ns, nested_ns;
+    if (get_item_int(entry, ENTRY_START, &start_time) < 0
+        || get_item_int(entry, ENTRY_CHILD_NS, &child_ns) < 0
+        || get_item_int(entry, ENTRY_NESTED_NS, &nested_ns) < 0) {
+        result = -1;
+        goto done;
+    }
+
+    if (stats == Py_None) {
+        /* Not timed: its traced callees are attributed to the caller */
+        if (PyList_SetSlice(stack, depth - 1, depth, NULL) < 0) {
+            result = -1;
+            goto done;
+        }
+        if (parent != NULL && (add_item_int(parent, ENTRY_CHILD_NS, child_ns) < 0
+                               || add_item_int(parent, ENTRY_NESTED_NS, nested_ns) < 0)) {
+            result = -1;
+            goto done;
+        }
+        result = 1;
+        goto done;
+    }
+
+    /* An exception unwinding the frame, and modes recording more than the
+       stats, are left to the tracer */
+    if (arg == NULL) {
+        goto done;
+    }
+    if (arg == Py_None) {
+        int unwinding = is_unwinding(frame, code);
+        if (unwinding != 0) {
+            result = unwinding < 0 ? -1 : 0;
+            goto done;
+        }
+    }
+    if (PyDict_GetItemWithError(settings, str_overhead_budget) != Py_None
+        || PyDict_GetItemWithError(settings, str_timeline) != Py_None
+        || PyDict_GetItemWithError(settings, str_event_log) != Py_None) {
+        result = PyErr_Occurred() ? -1 : 0;
+        goto done;
+    }
+
+    long long end_time, overhead_ns, hidden_ns;
+    if (read_clock(&end_time) < 0
+        || get_setting(settings, str_hook_overhead_ns, &overhead_ns) < 0
+        || get_setting(settings, str_hidden_overhead_ns, &hidden_ns) < 0
+        || PyList_SetSlice(stack, depth - 1, depth, NULL) < 0) {
+        result = -1;
+        goto done;
+    }
+
+    long long elapsed = end_time - start_time;
+    long long duration = elapsed - overhead_ns - nested_ns;
+    if (duration < 0) {
+        duration = 0;
+    }
+    long long self_duration = elapsed - overhead_ns - child_ns;
+    if (self_duration < 0) {
+        self_duration = 0;
+    }
+
+    /* FunctionTracer._record() */
+    long long min_ns, max_ns;
+    if (add_int(stats, str_timed_count, 1) < 0
+        || add_int(stats, str_total_ns, duration) < 0
+        || add_int(stats, str_self_ns, self_duration) < 0
+        || get_int(stats, str_min_ns, &min_ns) < 0
+        || get_int(stats, str_max_ns, &max_ns) < 0
+        || (duration < min_ns && set_int(stats, str_min_ns, duration) < 0)
+        || (duration > max_ns && set_int(stats, str_max_ns, duration) < 0)
+        || record_histogram(stats, duration) < 0) {
+        result = -1;
+        goto done;
+    }
+    PyObject *sketch = PyObject_GetAttr(stats, str_sketch);
+    if (sketch == NULL) {
+        result = -1;
+        goto done;
+    }
+    if (sketch != Py_None) {
+        PyObject *number = PyLong_FromLongLong(duration);
+        PyObject *returned = number != NULL ? PyObject_CallMethodOneArg(sketch, str_add, number) : NULL;
+        Py_XDECREF(number);
+        if (returned == NULL) {
+            Py_DECREF(sketch);
+            result = -1;
+            goto done;
+        }
+        Py_DECREF(returned);
+    }
+    Py_DECREF(sketch);
+
+    PyObject *path = PyList_GET_ITEM(entry, ENTRY_PATH);
+    if (add_int(path, str_call_count, 1) < 0
+        || add_int(path, str_total_ns, duration) < 0
+        || add_int(path, str_self_ns, self_duration) < 0) {
+        result = -1;
+        goto done;
+    }
+
+    if (parent != NULL) {
+        if (add_item_int(parent, ENTRY_CHILD_NS, elapsed + hidden_ns) < 0
+            || add_item_int(parent, ENTRY_NESTED_NS, nested_ns + overhead_ns + hidden_ns) < 0) {
+            result = -1;
+            goto done;
+        }
+        PyObject *edges = PyDict_GetItemWithError(state, str_edges);
+        PyObject *key = edges != NULL ? PyTuple_Pack(2, PyList_GET_ITEM(parent, ENTRY_NODE),
+                                                     PyList_GET_ITEM(entry, ENTRY_NODE)) : NULL;
+        /* A defaultdict, which creates missing edges */
+        edge = key != NULL ? PyObject_GetItem(edges, key) : NULL;
+        Py_XDECREF(key);
+        if (edge == NULL
+            || add_int(edge, str_call_count, 1) < 0
+            || add_int(edge, str_total_ns, duration) < 0
+            || add_int(edge, str_self_ns, self_duration) < 0) {
+            result = -1;
+            goto done;
+        }
+    }
+    result = 1;
+
+done:
+    Py_XDECREF(edge);
+    Py_XDECREF(entry);
+    return result;
+}
+
+/*
+ * Handle a 'call' or 'return' event of a traced function in C if possible.
+ * Returns 1 if handled, 0 to forward the event, -1 on error.
+ */
+static int
+profile_hook_fast(ProfileHookObject *self, PyFrameObject *frame, PyCodeObject *code, int what, PyObject *arg)
+{
+    if (self->tracer == NULL) {
+        return 0;
+    }
+    /* The tracer's settings and the thread's state are read from their
+       instance dicts, plain dict lookups being much cheaper than getattr */
+    PyObject *settings = PyObject_GenericGetDict(self->tracer, NULL);
+    if (settings == NULL) {
+        return -1;
+    }
+    int result = 0;
+    PyObject *state = NULL;
+    /* A disabled tracer removes the hook from the thread, see tracer.py */
+    if (PyDict_GetItemWithError(settings, str_enabled) != Py_True) {
+        result = PyErr_Occurred() ? -1 : 0;
+        goto done;
+    }
+    PyObject *local = PyDict_GetItemWithError(settings, str_local);
+    if (local == NULL) {
+        result = PyErr_Occurred() ? -1 : 0;
+        goto done;
+    }
+    /* threading.local returns the dict of the current thread */
+    state = PyObject_GetAttr(local, str_dict);
+    if (state == NULL || !PyDict_Check(state)) {
+        result = state == NULL ? -1 : 0;
+        goto done;
+    }
+    if (what == PyTrace_CALL) {
+        result = fast_call(self, state, frame, code);
+    }
+    else if (!(code->co_flags & SUSPENDABLE_FLAGS)) {
+        result = fast_return(settings, state, frame, code, arg);
+    }
+
+done:
+    Py_XDECREF(state);
+    Py_DECREF(settings);
+    return result;
+}
+
+static int
+profile_hook_forward(ProfileHookObject *self, PyFrameObject *frame, int what, PyObject *arg)
+{
+    PyObject *args[3] = {(PyObject *)frame, event_strings[what], arg != NULL ? arg : Py_None};
+    PyObject *result = PyObject_Vectorcall(self->callback, args, 3, NULL);
+    if (result == NULL) {
+        /* Same as sys.setprofile(): a failing profile function is removed */
+        PyEval_SetProfile(NULL, NULL);
+        return -1;
+    }
+    Py_DECREF(result);
+    return 0;
+}
+
+static int
+profile_hook_dispatch(PyObject *obj, PyFrameObject *frame, int what, PyObject *arg)
+{
+    ProfileHookObject *self = (ProfileHookObject *)obj;
+    int traced;
+
+    switch (what) {
+    case PyTrace_CALL:
+    case PyTrace_RETURN: {
+        PyCodeObject *code = PyFrame_GetCode(frame);
+        traced = PyDict_Contains(self->code_index, (PyObject *)code);
+        if (traced > 0) {
+            traced = profile_hook_fast(self, frame, code, what, arg);
+            if (traced == 0) {
+                traced = 1;  /* Forwarded */
+            }
+            else if (traced > 0) {
+                Py_DECREF(code);
+                return 0;
+            }
+            else {
+                /* Same as the tracer's profile function: report and go on */
+                PyErr_WriteUnraisable((PyObject *)self);
+                Py_DECREF(code);
+                return 0;
+            }
+        }
+        Py_DECREF(code);
+        break;
+    }
+    case PyTrace_C_CALL:
+    case PyTrace_C_RETURN:
+    case PyTrace_C_EXCEPTION:
+        traced = PySet_Contains(self->builtins, arg);
+        break;
+    default:
+        return 0;
+    }
+
+    if (traced <= 0) {
+        if (traced < 0) {
+            /* e.g. an unhashable callable: it cannot be traced either */
+            PyErr_Clear();
+        }
+        return 0;
+    }
+    return profile_hook_forward(self, frame, what, arg);
+}
+
+static PyObject *
+ProfileHook_new(PyTypeObject *type, PyObject *args, PyObject *kwargs)
+{
+    static char *keywords[] = {"callback", "code_index", "builtins", "tracer", NULL};
+    PyObject *callback, *code_index, *builtins, *tracer = Py_None;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "OO!O!|$O:ProfileHook", keywords,
+                                     &callback, &PyDict_Type, &code_index,
+                                     &PySet_Type, &builtins, &tracer)) {
+        return NULL;
+    }
+    if (!PyCallable_Check(callback)) {
+        PyErr_SetString(PyExc_TypeError, "callback must be callable");
+        return NULL;
+    }
+
+    ProfileHookObject *self = (ProfileHookObject *)type->tp_alloc(type, 0);
+    if (self == NULL) {
+        return NULL;
+    }
+    self->callback = Py_NewRef(callback);
+    self->code_index = Py_NewRef(code_index);
+    self->builtins = Py_NewRef(builtins);
+    self->tracer = tracer != Py_None ? Py_NewRef(tracer) : NULL;
+    return (PyObject *)self;
+}
+
+static int
+ProfileHook_traverse(ProfileHookObject *self, visitproc visit, void *arg)
+{
+    Py_VISIT(self->callback);
+    Py_VISIT(self->code_index);
+    Py_VISIT(self->builtins);
+    Py_VISIT(self->tracer);
+    return 0;
+}
+
+static int
+ProfileHook_clear(ProfileHookObject *self)
+{
+    Py_CLEAR(self->callback);
+    Py_CLEAR(self->code_index);
+    Py_CLEAR(self->builtins);
+    Py_CLEAR(self->tracer);
+    return 0;
+}
+
+static void
+ProfileHook_dealloc(ProfileHookObject *self)
+{
+    PyObject_GC_UnTrack(self);
+    ProfileHook_clear(self);
+    Py_TYPE(self)->tp_free((PyObject *)self);
+}
+
+/*
+ * Called as a regular profile function, e.g. in a thread started after
+ * threading.setprofile(hook): install the hook natively in that thread,
+ * then handle the event like the native hook would.
+ */
+static PyObject *
+ProfileHook_call(ProfileHookObject *self, PyObject *args, PyObject *kwargs)
+{
+    static char *keywords[] = {"frame", "event", "arg", NULL};
+    PyObject *frame, *event, *arg;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O!UO:ProfileHook", keywords,
+                                     &PyFrame_Type, &frame, &event, &arg)) {
+        return NULL;
+    }
+    PyEval_SetProfile(profile_hook_dispatch, (PyObject *)self);
+
+    for (int what = 0; what < EVENT_COUNT; what++) {
+        if (PyUnicode_Compare(event, event_strings[what]) == 0) {
+            if (profile_hook_dispatch((PyObject *)self, (PyFrameObject *)frame, what, arg) < 0) {
+                return NULL;
+            }
+            break;
+        }
+    }
+    Py_RETURN_NONE;
+}
+
+static PyObject *
+ProfileHook_install(ProfileHookObject *self, PyObject *args, PyObject *kwargs)
+{
+    static char *keywords[] = {"all_threads", NULL};
+    int all_threads = 0;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "|$p:install", keywords, &all_threads)) {
+        return NULL;
+    }
+#if PY_VERSION_HEX >= 0x030C0000
+    if (all_threads) {
+        PyEval_SetProfileAllThreads(profile_hook_dispatch, (PyObject *)self);
+        Py_RETURN_NONE;
+    }
+#endif
+    PyEval_SetProfile(profile_hook_dispatch, (PyObject *)self);
+    Py_RETURN_NONE;
+}
+
+static PyObject *
+ProfileHook_get_code_index(ProfileHookObject *self, void *closure)
+{
+    return Py_NewRef(self->code_index);
+}
+
+static int
+ProfileHook_set_code_index(ProfileHookObject *self, PyObject *value, void *closure)
+{
+    if (value == NULL || !PyDict_Check(value)) {
+        PyErr_SetString(PyExc_TypeError, "code_index must be a dict");
+        return -1;
+    }
+    Py_SETREF(self->code_index, Py_NewRef(value));
+    return 0;
+}
+
+static PyObject *
+ProfileHook_get_builtins(ProfileHookObject *self, void *closure)
+{
+    return Py_NewRef(self->builtins);
+}
+
+static int
+ProfileHook_set_builtins(ProfileHookObject *self, PyObject *value, void *closure)
+{
+    if (value == NULL || !PySet_Check(value)) {
+        PyErr_SetString(PyExc_TypeError, "builtins must be a set");
+        return -1;
+    }
+    Py_SETREF(self->builtins, Py_NewRef(value));
+    return 0;
+}
+
+static PyMethodDef ProfileHook_methods[] = {
+    {"install", (PyCFunction)(void (*)(void))ProfileHook_install, METH_VARARGS | METH_KEYWORDS,
+     PyDoc_STR("install(*, all_threads=False)\n--\n\n"
+               "Install the hook with PyEval_SetProfile() in the current thread, or in\n"
+               "every running thread on Python 3.12+ if all_threads is true.")},
+    {NULL, NULL, 0, NULL},
+};
+
+static PyGetSetDef ProfileHook_getset[] = {
+    {"code_index", (getter)ProfileHook_get_code_index, (setter)ProfileHook_set_code_index,
+     PyDoc_STR("Dict whose keys are the code objects of traced functions."), NULL},
+    {"builtins", (getter)ProfileHook_get_builtins, (setter)ProfileHook_set_builtins,
+     PyDoc_STR("Set of traced built-in functions."), NULL},
+    {NULL, NULL, NULL, NULL, NULL},
+};
+
+static PyTypeObject ProfileHookType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    .tp_name = "_tracer_speedups.ProfileHook",
+    .tp_doc = PyDoc_STR("ProfileHook(callback, code_index, builtins, *, tracer=None)\n--\n\n"
+                        "Profiler hook forwarding the events of traced functions to callback.\n"
+                        "Given the FunctionTracer, it handles their common events itself."),
+    .tp_basicsize = sizeof(ProfileHookObject),
+    .tp_flags = Py_TPFLAGS_DEFAULT | Py_TPFLAGS_HAVE_GC,
+    .tp_new = ProfileHook_new,
+    .tp_dealloc = (destructor)ProfileHook_dealloc,
+    .tp_traverse = (traverseproc)ProfileHook_traverse,
+    .tp_clear = (inquiry)ProfileHook_clear,
+    .tp_call = (ternaryfunc)ProfileHook_call,
+    .tp_methods = ProfileHook_methods,
+    .tp_getset = ProfileHook_getset,
+};
+
+static struct PyModuleDef speedups_module = {
+    PyModuleDef_HEAD_INIT,
+    .m_name = "_tracer_speedups",
+    .m_doc = PyDoc_STR("Compiled profiler hook for tracer.FunctionTracer."),
+    .m_size = -1,
+};
+
+static int
+intern_names(void)
+{
+    struct {
+        PyObject **target;
+        const char *name;
+    } names[] = {
+        {&str_enabled, "_enabled"}, {&str_local, "_local"}, {&str_stack, "stack"},
+        {&str_stats, "stats"}, {&str_paths, "paths"}, {&str_edges, "edges"},
+        {&str_children, "children"}, {&str_call_count, "call_count"},
+        {&str_timed_count, "timed_count"}, {&str_sample_rate, "sample_rate"},
+        {&str_total_ns, "total_ns"}, {&str_self_ns, "self_ns"}, {&str_min_ns, "min_ns"},
+        {&str_max_ns, "max_ns"}, {&str_histogram, "histogram"}, {&str_counts, "counts"},
+        {&str_record, "record"}, {&str_sketch, "sketch"}, {&str_add, "add"},
+        {&str_hook_overhead_ns, "_hook_overhead_ns"},
+        {&str_hidden_overhead_ns, "_hidden_overhead_ns"},
+        {&str_overhead_budget, "_overhead_budget"}, {&str_timeline, "_timeline"},
+        {&str_event_log, "_event_log"}, {&str_f_lasti, "f_lasti"}, {&str_co_code, "co_code"},
+        {&str_dict, "__dict__"},
+    };
+    for (size_t i = 0; i < sizeof(names) / sizeof(names[0]); i++) {
+        if (*names[i].target == NULL) {
+            *names[i].target = PyUnicode_InternFromString(names[i].name);
+            if (*names[i].target == NULL) {
+                return -1;
+            }
+        }
+    }
+    PyObject *dis = PyImport_ImportModule("dis");
+    PyObject *opmap = dis != NULL ? PyObject_GetAttrString(dis, "opmap") : NULL;
+    Py_XDECREF(dis);
+    if (opmap == NULL) {
+        return -1;
+    }
+    const char *return_names[] = {"RETURN_VALUE", "RETURN_CONST"};
+    for (int i = 0; i < 2; i++) {
+        PyObject *op = PyMapping_GetItemString(opmap, return_names[i]);
+        if (op == NULL) {
+            PyErr_Clear();
+            continue;
+        }
+        return_ops[i] = (int)PyLong_AsLong(op);
+        Py_DECREF(op);
+    }
+    Py_DECREF(opmap);
+    if (PyErr_Occurred()) {
+        return -1;
+    }
+#if PY_VERSION_HEX < 0x030D0000
+    if (perf_counter_ns == NULL) {
+        PyObject *time = PyImport_ImportModule("time");
+        if (time == NULL) {
+            return -1;
+        }
+        perf_counter_ns = PyObject_GetAttrString(time, "perf_counter_ns");
+        Py_DECREF(time);
+        if (perf_counter_ns == NULL) {
+            return -1;
+        }
+    }
+#endif
+    return 0;
+}
+
+PyMODINIT_FUNC
+PyInit__tracer_speedups(void)
+{
+    if (intern_names() < 0) {
+        return NULL;
+    }
+    for (int what = 0; what < EVENT_COUNT; what++) {
+        if (event_strings[what] == NULL) {
+            event_strings[what] = PyUnicode_InternFromString(event_names[what]);
+            if (event_strings[what] == NULL) {
+                return NULL;
+            }
+        }
+    }
+    if (PyType_Ready(&ProfileHookType) < 0) {
+        return NULL;
+    }
+
+    PyObject *module = PyModule_Create(&speedups_module);
+    if (module == NULL) {
+        return NULL;
+    }
+    if (PyModule_AddObjectRef(module, "ProfileHook", (PyObject *)&ProfileHookType) < 0) {
+        Py_DECREF(module);
+        return NULL;
+    }
+    return module;
+}
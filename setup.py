@@ -0,0 +1,13 @@
+from setuptools import setup, Extension
+
+setup(
+    name="function-tracer",
+    version="0.1.0",
+    description="Trace and time selected Python functions",
+    py_modules=["tracer"],
+    ext_modules=[
+        # Optional accelerator for the 'profile' engine, tracer.py works without it
+        Extension("_tracer_speedups", sources=["_tracer_speedups.c"], optional=True),
+    ],
+    python_requires=">=3.10",
+)
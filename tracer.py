@@ -1,31 +1,905 @@
+import os
+import dis
 import sys
+import math
 import time
 import inspect
 import functools
-from typing import Dict, List, Callable, Set, Any, Tuple, Optional
-from dataclasses import dataclass
+import threading
+import statistics
+import contextlib
+import json
+import mmap
+import struct
+import itertools
+from array import array
+from types import CodeType
+from typing import Dict, List, Callable, Set, Any, Tuple, Optional, Iterator, TextIO, Union
+from dataclasses import dataclass, field
 from collections import defaultdict
+from collections.abc import Coroutine
+
+# sys.monitoring (PEP 669) is only available on Python 3.12+
+_HAS_MONITORING = hasattr(sys, 'monitoring')
+
+# Optional compiled hook for the 'profile' engine, built by setup.py
+try:
+    import _tracer_speedups
+except ImportError:
+    _tracer_speedups = None
+
+# Largest value of a signed 64-bit integer, FunctionStats.min_ns before any call
+_MAX_NS = 2 ** 63 - 1
+
+# LatencyHistogram layout: each power of two is split into 2**_SUB_BUCKET_BITS
+# linear sub-buckets, giving at most 1/16 relative bucket width up to 2**40ns
+# (about 18 minutes); longer durations are counted in the last bucket
+_SUB_BUCKET_BITS = 4
+_SUB_BUCKETS = 1 << _SUB_BUCKET_BITS
+_HISTOGRAM_MAX_BITS = 40
+# Sampling: upper bound of the adaptive 1-in-N rate, and the assumed cost of
+# timing one call and of only counting one call until something better is known
+_MAX_SAMPLE_RATE = 1024
+_DEFAULT_EVENT_COST_NS = 2000
+_DEFAULT_COUNT_COST_NS = 600
+
+# Sampling rate of functions demoted to counting only, no call is ever timed
+_COUNT_ONLY_RATE = 2 ** 62
+
+# Calls made to an empty function by each step of the overhead calibration
+_CALIBRATION_ROUNDS = 2000
+
+# The overhead governor re-evaluates a function after every this many timed calls
+_GOVERNOR_INTERVAL = 16
+
+# Code of generators and coroutines, whose frames return at every suspension.
+# A frame returning at YIELD_VALUE (up to 3.12), or already at the RESUME after
+# it (3.13+, oparg > 0), is only suspended; RESUME with oparg 0 is a first start.
+# On 3.10, which has no RESUME, a frame suspended in `yield from` or `await`
+# returns at the instruction before YIELD_FROM.
+_SUSPENDABLE_FLAGS = inspect.CO_GENERATOR | inspect.CO_COROUTINE | inspect.CO_ASYNC_GENERATOR
+_YIELD_VALUE = dis.opmap['YIELD_VALUE']
+_RESUME = dis.opmap.get('RESUME', -1)
+_YIELD_FROM = dis.opmap.get('YIELD_FROM', -1)
+# A frame whose 'return' event is not at one of these is unwinding on an exception
+_RETURN_OPS = frozenset(dis.opmap[name] for name in ('RETURN_VALUE', 'RETURN_CONST') if name in dis.opmap)
+
+# Generator and coroutine invocations followed at once. Invocations closed
+# without running any code (3.13+) produce no event, and the oldest are
+# forgotten beyond this limit
+_MAX_INVOCATIONS = 1 << 16
+
+_HISTOGRAM_BUCKETS = (_HISTOGRAM_MAX_BITS - _SUB_BUCKET_BITS + 1) << _SUB_BUCKET_BITS
+
+
+@dataclass(slots=True)
+class LatencyHistogram:
+    """
+    Fixed-memory log-linear (HDR-style) histogram of durations in nanoseconds.
+
+    Recording is O(1): the bucket index is derived from the bit length of
+    the value, so no search over bucket boundaries is needed.
 
+    Most stats records are never timed (merge targets, records of threads
+    that never called the function), so the buckets are only allocated by
+    the first record(). Counts are 32-bit and widened to 64-bit on overflow.
+    """
+    counts: Optional[array] = None  # Count per bucket, None until something is recorded
+
+    @staticmethod
+    def bucket_index(value: int) -> int:
+        """Index of the bucket holding a duration in nanoseconds."""
+        shift = value.bit_length() - _SUB_BUCKET_BITS - 1
+        if shift < 0:
+            return value
+        index = (shift << _SUB_BUCKET_BITS) + (value >> shift)
+        return index if index < _HISTOGRAM_BUCKETS else _HISTOGRAM_BUCKETS - 1
+
+    @staticmethod
+    def bucket_bounds(index: int) -> Tuple[int, int]:
+        """Lowest value and width of a bucket, in nanoseconds."""
+        if index < 2 * _SUB_BUCKETS:
+            return index, 1
+        shift = (index >> _SUB_BUCKET_BITS) - 1
+        return (index - (shift << _SUB_BUCKET_BITS)) << shift, 1 << shift
+
+    def record(self, value: int) -> None:
+        """Count one duration in nanoseconds."""
+        counts = self.counts
+        if counts is None:
+            counts = self.counts = array('I', bytes(4 * _HISTOGRAM_BUCKETS))
+        shift = value.bit_length() - _SUB_BUCKET_BITS - 1
+        if shift < 0:
+            index = value
+        else:
+            index = (shift << _SUB_BUCKET_BITS) + (value >> shift)
+            if index >= _HISTOGRAM_BUCKETS:
+                index = _HISTOGRAM_BUCKETS - 1
+        try:
+            counts[index] += 1
+        except OverflowError:
+            self._widen()[index] += 1
+
+    def merge(self, other: 'LatencyHistogram') -> None:
+        """Add the counts of another histogram to this one."""
+        if other.counts is None:
+            return
+        if self.counts is None:
+            self.counts = array(other.counts.typecode, other.counts)
+            return
+        counts = self.counts
+        for index, count in enumerate(other.counts):
+            if count:
+                try:
+                    counts[index] += count
+                except OverflowError:
+                    counts = self._widen()
+                    counts[index] += count
+
+    def _widen(self) -> array:
+        """Switch to 64-bit counts, once a 32-bit count would overflow."""
+        self.counts = array('Q', self.counts)
+        return self.counts
+
+    def percentile(self, percent: float) -> int:
+        """
+        Estimate a percentile of the recorded durations.
+
+        Args:
+            percent: Percentile to compute, between 0 and 100
+
+        Returns:
+            Midpoint of the bucket holding the percentile, in nanoseconds,
+            or 0 if nothing was recorded
+        """
+        if self.counts is None:
+            return 0
+        total = sum(self.counts)
+        if total == 0:
+            return 0
+
+        rank = max(1, -(-total * percent // 100))  # ceil without float rounding
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                low, width = self.bucket_bounds(index)
+                return low + width // 2
+        return 0
+
+
+class DDSketch:
+    """
+    Mergeable quantile sketch with a relative-error guarantee (DDSketch).
+
+    Durations are counted in logarithmically sized bins, so any quantile is
+    estimated within `relative_accuracy` of the true value whether calls take
+    nanoseconds or minutes. Memory is bounded by `max_bins`: when exceeded,
+    the lowest bins are collapsed together, which keeps the upper quantiles
+    accurate. Sketches with the same relative_accuracy can be merged, and
+    to_dict()/from_dict() allow merging sketches from other processes.
+
+    Any object with add(), merge(), copy() and quantile() can be used in
+    place of DDSketch through FunctionTracer(sketch_factory=...).
+    """
+    __slots__ = ('relative_accuracy', 'max_bins', 'zero_count', 'bins', '_gamma', '_inv_log_gamma')
+
+    def __init__(self, relative_accuracy: float = 0.01, max_bins: int = 2048):
+        if not 0 < relative_accuracy < 1:
+            raise ValueError("relative_accuracy must be between 0 and 1")
+
+        self.relative_accuracy = relative_accuracy
+        self.max_bins = max_bins
+        self.zero_count = 0  # Durations of 0ns, which have no logarithm
+        self.bins: Dict[int, int] = {}  # Bin index -> count
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._inv_log_gamma = 1 / math.log(self._gamma)
+
+    @property
+    def count(self) -> int:
+        """Number of values added to the sketch."""
+        return self.zero_count + sum(self.bins.values())
+
+    def add(self, value: int) -> None:
+        """Add one duration in nanoseconds."""
+        if value <= 0:
+            self.zero_count += 1
+            return
 
-@dataclass
+        index = math.ceil(math.log(value) * self._inv_log_gamma)
+        bins = self.bins
+        if index in bins:
+            bins[index] += 1
+        else:
+            bins[index] = 1
+            if len(bins) > self.max_bins:
+                self._collapse()
+
+    def merge(self, other: 'DDSketch') -> None:
+        """Add the values of another sketch with the same relative accuracy."""
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Cannot merge sketches with different relative accuracy")
+
+        self.zero_count += other.zero_count
+        bins = self.bins
+        for index, count in list(other.bins.items()):
+            bins[index] = bins.get(index, 0) + count
+        if len(bins) > self.max_bins:
+            self._collapse()
+
+    def copy(self) -> 'DDSketch':
+        """Create an independent copy of the sketch."""
+        sketch = DDSketch(self.relative_accuracy, self.max_bins)
+        sketch.zero_count = self.zero_count
+        sketch.bins = dict(self.bins)
+        return sketch
+
+    def quantile(self, q: float) -> float:
+        """
+        Estimate a quantile of the added values.
+
+        Args:
+            q: Quantile to compute, between 0 and 1
+
+        Returns:
+            Estimated value in nanoseconds, or 0 if the sketch is empty
+        """
+        count = self.count
+        if count == 0:
+            return 0.0
+
+        rank = max(1, math.ceil(q * count))  # Nearest rank, as in LatencyHistogram
+        seen = self.zero_count
+        if seen >= rank:
+            return 0.0
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if seen >= rank:
+                return 2 * self._gamma ** index / (self._gamma + 1)
+        return 2 * self._gamma ** max(self.bins) / (self._gamma + 1)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Serialize the sketch into JSON-compatible data."""
+        return {
+            'relative_accuracy': self.relative_accuracy,
+            'max_bins': self.max_bins,
+            'zero_count': self.zero_count,
+            'bins': {str(index): count for index, count in self.bins.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'DDSketch':
+        """Rebuild a sketch serialized with to_dict()."""
+        sketch = cls(data['relative_accuracy'], data['max_bins'])
+        sketch.zero_count = data['zero_count']
+        sketch.bins = {int(index): count for index, count in data['bins'].items()}
+        return sketch
+
+    def _collapse(self) -> None:
+        """Fold the lowest bins into one until at most max_bins remain."""
+        indexes = sorted(self.bins)
+        excess = len(indexes) - self.max_bins
+        target = indexes[excess]
+        for index in indexes[:excess]:
+            self.bins[target] += self.bins.pop(index)
+
+
+@dataclass(slots=True)
 class FunctionStats:
-    """Class for storing statistics about a traced function."""
-    call_count: int = 0
-    total_time: float = 0.0  # Total execution time in seconds
-    min_time: float = float('inf')  # Minimum execution time seen
-    max_time: float = 0.0  # Maximum execution time seen
+    """
+    Class for storing statistics about a traced function.
+
+    Durations are accumulated as integer nanoseconds from perf_counter_ns(),
+    which stays exact over millions of calls; the *_time properties convert
+    them to seconds on read. Instances use __slots__ so that tracing many
+    functions across many thread shards stays compact.
+
+    With sampling, every call is counted in call_count but only 1 in
+    sample_rate calls is timed (timed_count). total_ns, min/max, the
+    histogram and the sketch cover timed calls only, and total_time is
+    estimated as call_count * total_ns / timed_count, i.e. the mean of the
+    timed calls applied to all calls. Since calls are sampled at a fixed
+    stride this is unbiased unless durations follow the same period.
+
+    total_ns is inclusive time, spent in the function and everything it
+    calls. self_ns is exclusive time: the timed durations of traced callees
+    are subtracted from their caller, so the self times of nested traced
+    functions add up to the inclusive time of the outermost one. Callees
+    that are not timed (untraced, or skipped by sampling) count as self time
+    of their caller.
+
+    A call of a generator or coroutine is one invocation from its first
+    start to its final return, however often it is suspended in between.
+    total_ns and self_ns only cover the time it was actually running
+    (active time), while wall_ns adds up the whole lifetime of its timed
+    invocations, including the time spent suspended.
+
+    The task_* fields are filled by FunctionTracer.instrument_asyncio() for
+    asyncio tasks running the coroutine, and split the life of every task
+    into running, awaiting and queued (ready but waiting for the event loop).
+
+    Timed calls that raised are also recorded, per exception type, in
+    exceptions. The totals above cover every call, successes() has the
+    calls that returned normally.
+    """
+    call_count: int = 0  # Calls started, sampled or not
+    timed_count: int = 0  # Calls whose duration was measured
+    total_ns: int = 0  # Total execution time of timed calls in nanoseconds
+    self_ns: int = 0  # Part of total_ns not spent in traced callees
+    wall_ns: int = 0  # Lifetime of timed generator and coroutine invocations
+    min_ns: int = _MAX_NS  # Minimum execution time seen
+    max_ns: int = 0  # Maximum execution time seen
+    sample_rate: int = 1  # Time 1 in sample_rate calls
+    histogram: LatencyHistogram = field(default_factory=LatencyHistogram)
+    sketch: Optional[DDSketch] = None  # Optional quantile sketch, see FunctionTracer(sketch_factory=...)
+    task_count: int = 0  # Finished asyncio tasks running this coroutine
+    task_running_ns: int = 0  # Time those tasks spent running steps
+    task_awaited_ns: int = 0  # Time they waited for what they awaited
+    task_queued_ns: int = 0  # Time they were ready to run but queued in the event loop
+    exceptions: Optional[Dict[type, 'FunctionStats']] = None  # Timed calls that raised, by exception type
+
+    @property
+    def total_time(self) -> float:
+        """Total execution time of all calls in seconds, estimated if sampled."""
+        if self.timed_count == 0:
+            return 0.0
+        return self.total_ns * self.call_count / self.timed_count / 1e9
+
+    @property
+    def self_time(self) -> float:
+        """Exclusive execution time of all calls in seconds, estimated if sampled."""
+        if self.timed_count == 0:
+            return 0.0
+        return self.self_ns * self.call_count / self.timed_count / 1e9
+
+    @property
+    def wall_time(self) -> float:
+        """Lifetime of all generator or coroutine invocations in seconds, estimated if sampled."""
+        if self.timed_count == 0:
+            return 0.0
+        return self.wall_ns * self.call_count / self.timed_count / 1e9
+
+    @property
+    def min_time(self) -> float:
+        """Minimum execution time in seconds, inf if there were no calls."""
+        return self.min_ns / 1e9 if self.timed_count > 0 else float('inf')
+
+    @property
+    def max_time(self) -> float:
+        """Maximum execution time in seconds."""
+        return self.max_ns / 1e9
 
     @property
     def avg_time(self) -> float:
         """Calculate average execution time."""
-        return self.total_time / self.call_count if self.call_count > 0 else 0
+        return self.total_ns / self.timed_count / 1e9 if self.timed_count > 0 else 0
+
+    @property
+    def exception_count(self) -> int:
+        """Number of timed calls that raised an exception."""
+        if not self.exceptions:
+            return 0
+        return sum(stats.timed_count for stats in self.exceptions.values())
+
+    @property
+    def success_count(self) -> int:
+        """Number of timed calls that returned normally."""
+        return self.timed_count - self.exception_count
+
+    def successes(self) -> 'FunctionStats':
+        """
+        Statistics of the timed calls that returned normally, without the
+        ones recorded in exceptions.
+
+        Returns:
+            This FunctionStats if no call raised. Otherwise a new one with
+            the exceptions subtracted; its min and max are then bounds of
+            histogram buckets, and it has no quantile sketch.
+        """
+        if not self.exceptions:
+            return self
+
+        successes = FunctionStats(sample_rate=self.sample_rate)
+        successes.histogram.merge(self.histogram)
+        successes.timed_count = self.timed_count
+        successes.total_ns = self.total_ns
+        successes.self_ns = self.self_ns
+        successes.wall_ns = self.wall_ns
+        for stats in self.exceptions.values():
+            successes.timed_count -= stats.timed_count
+            successes.total_ns -= stats.total_ns
+            successes.self_ns -= stats.self_ns
+            successes.wall_ns -= stats.wall_ns
+            counts = successes.histogram.counts
+            for index, count in enumerate(stats.histogram.counts or ()):
+                if count:
+                    counts[index] -= count
+        successes.call_count = successes.timed_count
+
+        buckets = [index for index, count in enumerate(successes.histogram.counts or ()) if count]
+        if buckets:
+            low, _ = LatencyHistogram.bucket_bounds(buckets[0])
+            high, width = LatencyHistogram.bucket_bounds(buckets[-1])
+            successes.min_ns = max(low, self.min_ns)
+            successes.max_ns = min(high + width - 1, self.max_ns)
+        return successes
+
+    @property
+    def mode(self) -> str:
+        """How calls are measured: 'timed', 'sampled' or 'counted' only."""
+        if self.sample_rate >= _COUNT_ONLY_RATE:
+            return 'counted'
+        return 'sampled' if self.sample_rate > 1 else 'timed'
+
+    def percentile(self, percent: float) -> float:
+        """
+        Estimate a percentile of the execution time, e.g. percentile(99).
+
+        Args:
+            percent: Percentile to compute, between 0 and 100
+
+        Returns:
+            Execution time in seconds, from the quantile sketch if one is
+            attached, otherwise from the histogram (accurate to about 3%)
+        """
+        if self.timed_count == 0:
+            return 0.0
+        if self.sketch is not None:
+            value = self.sketch.quantile(percent / 100)
+        else:
+            value = self.histogram.percentile(percent)
+        # The bucket midpoint can fall outside the observed range
+        return min(max(value, self.min_ns), self.max_ns) / 1e9
+
+    def merge(self, other: 'FunctionStats') -> None:
+        """Add the statistics collected in another FunctionStats to this one."""
+        self.call_count += other.call_count
+        self.timed_count += other.timed_count
+        self.total_ns += other.total_ns
+        self.self_ns += other.self_ns
+        self.wall_ns += other.wall_ns
+        self.task_count += other.task_count
+        self.task_running_ns += other.task_running_ns
+        self.task_awaited_ns += other.task_awaited_ns
+        self.task_queued_ns += other.task_queued_ns
+        if other.exceptions:
+            if self.exceptions is None:
+                self.exceptions = {}
+            for error, stats in list(other.exceptions.items()):
+                if error not in self.exceptions:
+                    self.exceptions[error] = FunctionStats()
+                self.exceptions[error].merge(stats)
+        # Shards are merged oldest first, the newest one has the current rate
+        self.sample_rate = other.sample_rate
+        self.min_ns = min(self.min_ns, other.min_ns)
+        self.max_ns = max(self.max_ns, other.max_ns)
+        self.histogram.merge(other.histogram)
+        if other.sketch is not None:
+            if self.sketch is None:
+                self.sketch = other.sketch.copy()
+            else:
+                self.sketch.merge(other.sketch)
+
+
+@dataclass(slots=True)
+class CallEdge:
+    """
+    Statistics of the calls from one traced function to another.
+
+    Only timed calls of the callee are recorded, and the caller is the
+    innermost enclosing traced call, which is not necessarily the direct
+    caller if untraced functions sit in between.
+    """
+    call_count: int = 0  # Timed calls of the callee made by the caller
+    total_ns: int = 0  # Inclusive time of those calls in nanoseconds
+    self_ns: int = 0  # Exclusive time of those calls in nanoseconds
+
+    @property
+    def total_time(self) -> float:
+        """Inclusive time of the calls in seconds."""
+        return self.total_ns / 1e9
+
+    @property
+    def self_time(self) -> float:
+        """Exclusive time of the calls in seconds."""
+        return self.self_ns / 1e9
+
+    def merge(self, other: 'CallEdge') -> None:
+        """Add the statistics collected in another CallEdge to this one."""
+        self.call_count += other.call_count
+        self.total_ns += other.total_ns
+        self.self_ns += other.self_ns
+
+
+@dataclass(slots=True)
+class CallPathNode:
+    """
+    Node of a prefix tree of traced call paths. Each node stands for one
+    unique stack of traced functions, the path from the root to it, so
+    repeated stacks share their nodes and memory grows with the number of
+    distinct paths rather than the number of calls.
+
+    Children are keyed by the code object of the callee, or the built-in
+    itself. As with CallEdge, only timed calls are recorded and untraced
+    functions do not appear on the paths.
+    """
+    node: Any = None  # Code object or built-in, None for the root
+    children: Dict[Any, 'CallPathNode'] = field(default_factory=dict)
+    call_count: int = 0  # Timed calls made through this path
+    total_ns: int = 0  # Inclusive time of those calls in nanoseconds
+    self_ns: int = 0  # Exclusive time of those calls in nanoseconds
+
+    @property
+    def total_time(self) -> float:
+        """Inclusive time of the calls in seconds."""
+        return self.total_ns / 1e9
+
+    @property
+    def self_time(self) -> float:
+        """Exclusive time of the calls in seconds."""
+        return self.self_ns / 1e9
+
+    def child(self, node: Any) -> 'CallPathNode':
+        """Get the child for a callee, creating it on first use."""
+        child = self.children.get(node)
+        if child is None:
+            child = self.children[node] = CallPathNode(node)
+        return child
+
+    def merge(self, other: 'CallPathNode') -> None:
+        """Add the statistics of another tree to this one, path by path."""
+        # Iterative, deep recursion of traced functions makes deep trees
+        pending = [(self, other)]
+        while pending:
+            target, source = pending.pop()
+            target.call_count += source.call_count
+            target.total_ns += source.total_ns
+            target.self_ns += source.self_ns
+            for node, child in list(source.children.items()):
+                pending.append((target.child(node), child))
+
+
+@dataclass(slots=True)
+class Calibration:
+    """Tracer costs measured on this machine when tracing is enabled."""
+    engine: Optional[str]  # Engine measured, None if only wrappers time calls
+    clock_overhead_ns: int = 0  # Cost of one perf_counter_ns() read
+    hook_overhead_ns: int = 0  # Tracer time included in each hook-measured duration
+    event_cost_ns: int = _DEFAULT_EVENT_COST_NS  # Time a timed call costs its caller
+    count_cost_ns: int = _DEFAULT_COUNT_COST_NS  # Time a counted-only call costs its caller
+    native_hook: bool = False  # Measured with the compiled profile hook
+
+
+class TimelineBuffer:
+    """
+    Fixed-size ring buffer of timed calls, for timeline exports such as
+    FunctionTracer.export_chrome_trace().
+
+    Each call is stored as one row across preallocated arrays, so recording
+    allocates no per-event object and memory stays at about 40 bytes per
+    slot however long tracing runs. When the buffer is full the oldest calls
+    are overwritten. Slots are claimed from an itertools.count, which is
+    atomic under the GIL, so threads can record without a lock.
+    """
+    __slots__ = ('capacity', '_positions', 'sequence', 'function_ids', 'thread_ids',
+                 'start_ns', 'duration_ns')
+
+    def __init__(self, capacity: int):
+        """
+        Args:
+            capacity: Number of calls kept, the most recent ones win
+        """
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1")
+
+        self.capacity = capacity
+        self._positions = itertools.count()
+        self.sequence = array('q', [-1]) * capacity  # Position of the call in each slot, -1 if unused
+        self.function_ids = array('q', [0]) * capacity
+        self.thread_ids = array('Q', [0]) * capacity
+        self.start_ns = array('q', [0]) * capacity
+        self.duration_ns = array('q', [0]) * capacity
+
+    def record(self, function_id: int, thread_id: int, start_ns: int, duration_ns: int) -> None:
+        """Store one call, overwriting the oldest one if the buffer is full."""
+        position = next(self._positions)
+        slot = position % self.capacity
+        self.function_ids[slot] = function_id
+        self.thread_ids[slot] = thread_id
+        self.start_ns[slot] = start_ns
+        self.duration_ns[slot] = duration_ns
+        self.sequence[slot] = position
+
+    def __len__(self) -> int:
+        """Number of calls currently stored."""
+        return self.capacity - self.sequence.count(-1)
+
+    @property
+    def dropped(self) -> int:
+        """Number of calls overwritten because the buffer was full."""
+        recorded = max(self.sequence) + 1
+        return recorded - len(self) if recorded > 0 else 0
+
+    def events(self) -> Iterator[Tuple[int, int, int, int]]:
+        """
+        Iterate over the stored calls, oldest first.
+
+        Yields:
+            (function_id, thread_id, start_ns, duration_ns) tuples
+        """
+        sequence = self.sequence
+        for slot in sorted((slot for slot in range(self.capacity) if sequence[slot] >= 0),
+                           key=sequence.__getitem__):
+            yield (self.function_ids[slot], self.thread_ids[slot],
+                   self.start_ns[slot], self.duration_ns[slot])
+
+
+# EventLog file layout: a 32-byte header (magic, record count), fixed-width
+# records (function id, thread id, start ns, duration ns), then the function
+# names as a JSON list
+_EVENT_LOG_MAGIC = b'FTEVLOG1'
+_EVENT_LOG_HEADER = struct.Struct('<8sQ16x')
+_EVENT_LOG_RECORD = struct.Struct('<qQqq')
+
+
+class EventLog:
+    """
+    Append-only binary log of timed calls in a memory-mapped file, for
+    captures too long to keep in memory, see FunctionTracer(event_log=...).
+
+    The file grows one chunk at a time; each chunk is mapped once and never
+    remapped, so recording is a struct.pack_into() into the current chunk.
+    Record slots are claimed from an itertools.count, which is atomic under
+    the GIL, so threads record without a lock except when a new chunk is
+    mapped. Tracing must be disabled before close(), which writes the record
+    count and function names and trims the unused end of the last chunk.
+    Read the file back with EventLogReader.
+    """
+
+    def __init__(self, path: str, chunk_size: int = 1 << 20):
+        """
+        Args:
+            path: File to create, an existing file is overwritten
+            chunk_size: Bytes the file grows by, a multiple of
+                        mmap.ALLOCATIONGRANULARITY
+        """
+        if chunk_size <= 0 or chunk_size % mmap.ALLOCATIONGRANULARITY:
+            raise ValueError(f"chunk_size must be a multiple of {mmap.ALLOCATIONGRANULARITY}")
+
+        self.path = path
+        self.functions: List[str] = []  # Function id -> name
+        self._chunk_size = chunk_size
+        self._chunk_records = chunk_size // _EVENT_LOG_RECORD.size
+        self._chunks: List[mmap.mmap] = []
+        self._chunks_lock = threading.Lock()
+        self._positions = itertools.count(1)  # Record slot 0 holds the header
+        self._file = open(path, 'w+b')
+        self._file.write(_EVENT_LOG_HEADER.pack(_EVENT_LOG_MAGIC, 0))
+        self._file.flush()
+
+    def add_function(self, function_id: int, name: str) -> None:
+        """Register the name recorded calls with function_id refer to."""
+        functions = self.functions
+        while len(functions) <= function_id:
+            functions.append("")
+        functions[function_id] = name
+
+    def record(self, function_id: int, thread_id: int, start_ns: int, duration_ns: int) -> None:
+        """Append one call to the log."""
+        position = next(self._positions)
+        chunk = position // self._chunk_records
+        if chunk >= len(self._chunks):
+            self._map_chunks(chunk)
+        _EVENT_LOG_RECORD.pack_into(self._chunks[chunk],
+                                    position % self._chunk_records * _EVENT_LOG_RECORD.size,
+                                    function_id, thread_id, start_ns, duration_ns)
+
+    def _map_chunks(self, chunk: int) -> None:
+        """Grow the file and map chunks until the given one exists."""
+        with self._chunks_lock:
+            while len(self._chunks) <= chunk:
+                offset = len(self._chunks) * self._chunk_size
+                self._file.truncate(offset + self._chunk_size)
+                self._chunks.append(mmap.mmap(self._file.fileno(), self._chunk_size, offset=offset))
+
+    def flush(self) -> None:
+        """Write the mapped records through to the file."""
+        for chunk in list(self._chunks):
+            chunk.flush()
+
+    def close(self) -> None:
+        """Finish the file: store the record count and function names."""
+        if self._file.closed:
+            return
+
+        count = next(self._positions) - 1
+        for chunk in self._chunks:
+            chunk.flush()
+            chunk.close()
+        self._chunks.clear()
+
+        end = (count + 1) * _EVENT_LOG_RECORD.size
+        self._file.truncate(end)
+        self._file.seek(end)
+        self._file.write(json.dumps(self.functions).encode('utf-8'))
+        self._file.seek(0)
+        self._file.write(_EVENT_LOG_HEADER.pack(_EVENT_LOG_MAGIC, count))
+        self._file.close()
+
+    def __enter__(self) -> 'EventLog':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+class EventLogReader:
+    """
+    Read an EventLog file without copying the records out of the mapping.
+
+    Iterating yields (function_id, thread_id, start_ns, duration_ns) tuples
+    unpacked straight from the mapped file. view exposes all records as one
+    memoryview of int64 values, four per record, which can be wrapped
+    without a copy, e.g. numpy.frombuffer(reader.view, dtype=numpy.int64)
+    .reshape(-1, 4). Views must be released before close().
+    """
+
+    def __init__(self, path: str):
+        """
+        Args:
+            path: File written by EventLog
+        """
+        with open(path, 'rb') as file:
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count = _EVENT_LOG_HEADER.unpack_from(self._mmap)
+        if magic != _EVENT_LOG_MAGIC:
+            self._mmap.close()
+            raise ValueError(f"Not an event log file: {path}")
+
+        end = (count + 1) * _EVENT_LOG_RECORD.size
+        self.functions: List[str] = json.loads(self._mmap[end:].decode('utf-8'))  # Function id -> name
+        self._records = memoryview(self._mmap)[_EVENT_LOG_RECORD.size:end]
+        self.view = self._records.cast('q')
+
+    def __len__(self) -> int:
+        """Number of records in the log."""
+        return len(self._records) // _EVENT_LOG_RECORD.size
+
+    def __iter__(self) -> Iterator[Tuple[int, int, int, int]]:
+        return _EVENT_LOG_RECORD.iter_unpack(self._records)
+
+    def close(self) -> None:
+        """Release the views and unmap the file."""
+        self.view.release()
+        self._records.release()
+        self._mmap.close()
+
+    def __enter__(self) -> 'EventLogReader':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+@contextlib.contextmanager
+def _open_output(output: Union[str, TextIO]) -> Iterator[TextIO]:
+    """Use an open text file as is, or open a path for writing."""
+    if hasattr(output, 'write'):
+        yield output
+    else:
+        with open(output, 'w', encoding='utf-8') as file:
+            yield file
+
+
+class _TaskCoroutine(Coroutine):
+    """
+    Wrapper around the coroutine of an asyncio task, installed by the task
+    factory of FunctionTracer.instrument_asyncio(). The task drives it
+    through send() and throw(), one call per step, which are timed here.
+
+    ready_ns is set by the instrumented loop.call_soon() when the task's
+    next step is scheduled: the time from the end of a step to ready_ns was
+    spent awaiting, and from ready_ns to the next step queued in the loop.
+    """
+    __slots__ = ('_coro', '_tracer', '_func', 'ready_ns', '_suspended_ns',
+                 '_running_ns', '_awaited_ns', '_queued_ns')
+
+    def __init__(self, coro: Coroutine, tracer: 'FunctionTracer', func: Callable):
+        self._coro = coro
+        self._tracer = tracer
+        self._func = func
+        self.ready_ns = 0
+        self._suspended_ns = 0
+        self._running_ns = 0
+        self._awaited_ns = 0
+        self._queued_ns = 0
+
+    def send(self, value: Any) -> Any:
+        return self._step(self._coro.send, value)
+
+    def throw(self, *args: Any) -> Any:
+        return self._step(self._coro.throw, *args)
+
+    def close(self) -> None:
+        self._coro.close()
+
+    def __await__(self):
+        return self._coro.__await__()
+
+    def __getattr__(self, name: str) -> Any:
+        # cr_code, __qualname__ and the like, used by task reprs
+        return getattr(self._coro, name)
+
+    def _step(self, method: Callable, *args: Any) -> Any:
+        """Run one step of the task and account for the time since the last one."""
+        start_time = time.perf_counter_ns()
+        if self.ready_ns:
+            if self._suspended_ns:
+                self._awaited_ns += self.ready_ns - self._suspended_ns
+            self._queued_ns += start_time - self.ready_ns
+            self.ready_ns = 0
+
+        try:
+            result = method(*args)
+        except BaseException:
+            # StopIteration included: the task has finished
+            self._running_ns += time.perf_counter_ns() - start_time
+            self._finish()
+            raise
+
+        self._suspended_ns = time.perf_counter_ns()
+        self._running_ns += self._suspended_ns - start_time
+        return result
+
+    def _finish(self) -> None:
+        """Add the finished task to the stats shard of the loop's thread."""
+        stats = self._tracer._local.stats[self._func]
+        stats.task_count += 1
+        stats.task_running_ns += self._running_ns
+        stats.task_awaited_ns += self._awaited_ns
+        stats.task_queued_ns += self._queued_ns
+
+
+def _calibration_target():
+    """Empty function traced by FunctionTracer to measure its own overhead."""
+
+
+class _ThreadState(threading.local):
+    """
+    Tracer state private to one thread, so that hooks running in different
+    threads never mutate shared data.
+    """
+
+    def __init__(self, shards: List['_Shard'], shards_lock: threading.Lock, stats_factory: Callable[[], FunctionStats]):
+        # Timed calls in progress, innermost last, shared by every engine and
+        # wrapper: [key, stats, start_time, child_ns, nested_overhead_ns, node,
+        # path, invocation, error]. node is the code object of the function,
+        # or the built-in itself, path its CallPathNode, invocation the running
+        # generator or coroutine invocation, if any, and error the type of the
+        # last exception raised in the frame (settrace only).
+        self.stack: List[list] = []
+        self.stale_entries = 0  # Entries dropped because their call exited unseen
+        self.stats: Dict[Callable, FunctionStats] = defaultdict(stats_factory)
+        self.edges: Dict[Tuple[Any, Any], CallEdge] = defaultdict(CallEdge)  # (caller node, callee node) -> edge
+        self.paths = CallPathNode()  # Root of the call paths started in this thread
+        self.thread_id = threading.get_ident()  # Recorded with timeline events
+        # Registration happens once per thread, the hooks themselves never lock
+        with shards_lock:
+            shards.append((threading.current_thread(), self.stats, self.edges, self.paths))
+
+
+# Data a thread shares with the collector: (thread, stats, call edges, call path root)
+_Shard = Tuple[threading.Thread, Dict[Callable, FunctionStats], Dict[Tuple[Any, Any], CallEdge], CallPathNode]
 
 
 class FunctionTracer:
     """
     A utility for tracing and measuring execution time of specific Python functions.
     """
+    ENGINES = ('settrace', 'profile', 'monitoring')
+
     _instance = None
+    _calibrations: Dict[Tuple[Optional[str], bool], Calibration] = {}  # Measured once per engine and process
 
     @classmethod
     def get_instance(cls):
@@ -35,7 +909,7 @@ class FunctionTracer:
         return cls._instance
 
     @classmethod
-    def trace(cls, func=None):
+    def trace(cls, func=None, *, timed: bool = False):
         """
         Decorator to mark a function for tracing.
 
@@ -44,12 +918,25 @@ class FunctionTracer:
             def function_to_trace():
                 pass
 
+            @FunctionTracer.trace(timed=True)
+            def function_to_time():
+                pass
+
+        Args:
+            timed: If True, the wrapper times each call itself while the
+                   singleton tracer is enabled, instead of relying on the
+                   tracing engine. If every traced function is timed this
+                   way, enable() installs no interpreter hook at all.
+
         Returns:
             The original function unchanged
         """
 
         def decorator(function):
             tracer = cls.get_instance()
+            if timed:
+                return tracer._timed_wrapper(function)
+
             if not hasattr(tracer, '_decorated_functions'):
                 tracer._decorated_functions = set()
             tracer._decorated_functions.add(function)
@@ -64,26 +951,110 @@ class FunctionTracer:
             return decorator
         return decorator(func)
 
-    def __init__(self):
+    def __init__(self, engine: Optional[str] = None,
+                 sketch_factory: Optional[Callable[[], DDSketch]] = None,
+                 calibrate: bool = True, timeline_capacity: int = 0,
+                 event_log: Optional[EventLog] = None, accelerate: bool = True):
+        """
+        Args:
+            engine: Hook used to observe function calls, one of ENGINES.
+                    If None, 'monitoring' is used on Python 3.12+ and
+                    'settrace' otherwise.
+            sketch_factory: Callable creating a quantile sketch to attach to
+                            each FunctionStats, e.g.
+                            lambda: DDSketch(relative_accuracy=0.005)
+            calibrate: Measure the tracer's own overhead on this machine when
+                       tracing is enabled and subtract it from every recorded
+                       duration. The measured costs also drive the overhead
+                       governor, see enable(overhead_budget=...).
+            timeline_capacity: If positive, also keep the start and duration
+                               of the last timeline_capacity timed calls in a
+                               TimelineBuffer, see export_chrome_trace()
+            event_log: EventLog to append every timed call to. It stays
+                       open when tracing is disabled and must be closed by
+                       the caller.
+            accelerate: Let the 'profile' engine use the compiled hook from
+                        _tracer_speedups if it is built, which drops the
+                        events of untraced functions without running any
+                        Python code. Without it, or if False, the engine
+                        uses sys.setprofile().
+        """
+        if engine is not None and engine not in self.ENGINES:
+            raise ValueError(f"Unknown tracing engine: {engine!r}")
+        if engine == 'monitoring' and not _HAS_MONITORING:
+            raise ValueError("The 'monitoring' engine requires Python 3.12+")
+
+        self._engine = engine  # Requested engine, None for automatic selection
+        self._active_engine: Optional[str] = None  # Engine installed by enable()
         self._enabled = False
         self._traced_functions: Set[Callable] = set()  # Regular functions being traced
+        self._code_index: Dict[CodeType, Callable] = {}  # __code__ -> traced function
         self._decorated_functions: Set[Callable] = set()  # Functions with @trace decorator
-        self._stats: Dict[Callable, FunctionStats] = defaultdict(FunctionStats)
-        self._call_stack: Dict[int, Tuple[Callable, float]] = {}  # thread_id -> (func, start_time)
+        self._shards: List[_Shard] = []  # Per-thread stats, call edges and call paths
+        self._shards_lock = threading.Lock()  # Guards _shards and the retired data
+        self._retired_stats: Dict[Callable, FunctionStats] = {}  # Stats of threads that have exited
+        self._retired_edges: Dict[Tuple[Any, Any], CallEdge] = {}  # Call edges of threads that have exited
+        self._retired_paths = CallPathNode()  # Call paths of threads that have exited
+        self._node_functions: Dict[Any, Callable] = {}  # Code object -> function, for call graph reports
+        self._sketch_factory = sketch_factory
+        self._timeline = TimelineBuffer(timeline_capacity) if timeline_capacity > 0 else None
+        self._event_log = event_log
+        self._function_ids: Dict[Any, int] = {}  # Node -> function id stored in the timeline and event log
+        self._function_nodes: List[Any] = []  # Function id -> node
+        self._function_ids_lock = threading.Lock()  # Guards assigning new function ids
+        self._sample_rate = 1  # Fixed 1-in-N sampling rate set by enable()
+        self._overhead_budget: Optional[float] = None  # Target overhead for adaptive sampling
+        self._event_cost_ns = _DEFAULT_EVENT_COST_NS  # Cost of timing one call
+        self._count_cost_ns = _DEFAULT_COUNT_COST_NS  # Cost of counting one call
+        self._calibrate = calibrate
+        self._calibration: Optional[Calibration] = None  # Calibration in effect
+        self._hook_overhead_ns = 0  # Subtracted from durations measured by hooks
+        self._clock_overhead_ns = 0  # Subtracted from durations measured by wrappers
+        self._hidden_overhead_ns = 0  # Tracer time a timed call adds outside its measured duration
         self._original_trace_function = None
+        self._original_profile_function = None
+        # Hooks that threads started from here on were given before enable(),
+        # restored by threads that remove the tracer's hook themselves
+        self._thread_trace_function = None
+        self._thread_profile_function = None
+        self._accelerate = accelerate and _tracer_speedups is not None
+        self._native_hook = None  # _tracer_speedups.ProfileHook while installed
+        self._local = _ThreadState(self._shards, self._shards_lock, self._new_stats)  # Call stacks and stats shard of each thread
+        self._monitored_codes: Set[CodeType] = set()  # Code objects with local events set
+        # Generator and coroutine invocations started but not finished, shared by
+        # all threads since they can be resumed anywhere:
+        # id(frame) -> [stats, first_start, active_ns, self_ns, throw_offset]
+        self._invocations: Dict[int, list] = {}
+        self._asyncio_loops: List[Tuple[Any, Optional[Callable]]] = []  # (loop, previous task factory)
 
         self._builtin_functions: Set[Callable] = set()  # Built-in functions being traced
         self._original_builtins: Dict[Callable, Callable] = {}  # Original built-in functions
         self._wrapped_builtins: Dict[Callable, Callable] = {}  # Wrapped built-in functions
 
-    def enable(self, functions: List[Callable] = None) -> None:
+    def enable(self, functions: List[Callable] = None, sample_rate: int = 1,
+               overhead_budget: Optional[float] = None) -> None:
         """
         Enable function tracing for the specified list of functions.
 
         Args:
             functions: List of function objects to trace. If None, only trace
                       functions decorated with @FunctionTracer.trace
+            sample_rate: Time only 1 in sample_rate calls of each function.
+                         Every call is still counted, see FunctionStats for
+                         how totals are estimated.
+            overhead_budget: If set, an overhead governor keeps the tracer's
+                             cost under this fraction of each function's own
+                             duration, e.g. 0.05 for 5%, by sampling its calls
+                             or demoting it to counting only
         """
+        if sample_rate < 1:
+            raise ValueError("sample_rate must be at least 1")
+        if overhead_budget is not None and overhead_budget <= 0:
+            raise ValueError("overhead_budget must be positive")
+        self._sample_rate = sample_rate
+        self._overhead_budget = overhead_budget
+        self._apply_sample_rate()
+
         if self._enabled:
             # If already enabled, update the function list
             if functions is not None:
@@ -99,12 +1070,15 @@ class FunctionTracer:
                 else:
                     self._traced_functions.add(func)
 
-        self._original_trace_function = sys.gettrace()
-        sys.settrace(self._trace_function)
-
-        self._setup_builtin_tracing()
-
+        # Set first: hooks that find the tracer disabled uninstall themselves
         self._enabled = True
+        self._rebuild_code_index()
+        if self._needs_hooks():
+            self._install_hooks()
+        if self._calibrate:
+            self._apply_calibration()
+        if self._active_engine != 'profile':
+            self._setup_builtin_tracing()
 
     def disable(self) -> Dict[Callable, FunctionStats]:
         """
@@ -114,16 +1088,23 @@ class FunctionTracer:
             Dictionary mapping functions to their execution statistics
         """
         if not self._enabled:
-            return dict(self._stats)
-
-        sys.settrace(self._original_trace_function)
+            return self._collect_results()
 
+        if self._active_engine is not None:
+            self._remove_hooks()
         self._restore_builtin_functions()
+        self._uninstrument_asyncio()
 
         self._enabled = False
-        self._call_stack.clear()
+        # Drop the call stacks of every thread. Their shards are folded into
+        # the retired data, so that the fresh state each thread registers on
+        # its next use does not pile up over enable/disable cycles
+        with self._shards_lock:
+            self._retire_shards(all_threads=True)
+        self._local = _ThreadState(self._shards, self._shards_lock, self._new_stats)
+        self._invocations.clear()
 
-        return dict(self._stats)
+        return self._collect_results()
 
     def update_functions(self, functions: List[Callable]) -> None:
         """
@@ -146,7 +1127,25 @@ class FunctionTracer:
             else:
                 self._traced_functions.add(func)
 
-        self._setup_builtin_tracing()
+        self._rebuild_code_index()
+        if self._active_engine is None:
+            if self._needs_hooks():
+                self._install_hooks()
+                if self._calibrate:
+                    self._apply_calibration()
+        elif self._active_engine == 'monitoring':
+            self._update_monitored_code()
+        if self._active_engine != 'profile':
+            self._setup_builtin_tracing()
+
+    @property
+    def engine(self) -> str:
+        """Name of the engine in use, or the one enable() will try first."""
+        if self._active_engine is not None:
+            return self._active_engine
+        if self._engine is not None:
+            return self._engine
+        return 'monitoring' if _HAS_MONITORING else 'settrace'
 
     def get_results(self) -> Dict[Callable, FunctionStats]:
         """
@@ -155,7 +1154,686 @@ class FunctionTracer:
         Returns:
             Dictionary mapping functions to their execution statistics
         """
-        return dict(self._stats)
+        return self._collect_results()
+
+    @property
+    def calibration(self) -> Optional[Calibration]:
+        """Tracer overhead measured by the last enable(), None if not calibrated."""
+        return self._calibration
+
+    def get_demoted_functions(self) -> Dict[Callable, FunctionStats]:
+        """
+        Get the functions the overhead governor sampled more sparsely than
+        requested, or demoted to counting only.
+
+        Returns:
+            Dictionary mapping demoted functions to their statistics
+        """
+        return {
+            func: stats
+            for func, stats in self._collect_results().items()
+            if stats.sample_rate > self._sample_rate
+        }
+
+    def get_call_graph(self) -> Dict[Tuple[Callable, Callable], CallEdge]:
+        """
+        Get the caller -> callee statistics of traced functions.
+
+        Returns:
+            Dictionary mapping (caller, callee) function pairs to the
+            statistics of the timed calls between them
+        """
+        node_functions = self._node_functions
+        return {
+            (node_functions.get(caller, caller), node_functions.get(callee, callee)): edge
+            for (caller, callee), edge in self._collect_call_graph().items()
+        }
+
+    def get_call_paths(self) -> CallPathNode:
+        """
+        Get the prefix tree of the traced call paths of every thread.
+
+        Returns:
+            Root node, whose children are the outermost traced calls and are
+            keyed by code object (or built-in), see iter_call_paths()
+        """
+        return self._collect_call_paths()
+
+    def iter_call_paths(self) -> Iterator[Tuple[Tuple[Callable, ...], CallPathNode]]:
+        """
+        Walk the call path tree depth first, e.g. to build flame graph data.
+
+        Yields:
+            (path, node) pairs, where path lists the traced functions from
+            the outermost call down to the node's function
+        """
+        node_functions = self._node_functions
+        root = self._collect_call_paths()
+        pending = [((node_functions.get(node, node),), child)
+                   for node, child in reversed(list(root.children.items()))]
+        while pending:
+            path, parent = pending.pop()
+            yield path, parent
+            for node, child in reversed(list(parent.children.items())):
+                pending.append((path + (node_functions.get(node, node),), child))
+
+    def format_call_graph(self) -> str:
+        """
+        Format the call graph in the Graphviz DOT language, e.g. to render it
+        with `dot -Tsvg`.
+
+        Returns:
+            DOT source of a directed graph with one edge per caller -> callee
+            pair, labelled with its call count, inclusive and self time
+        """
+        node_ids: Dict[Callable, str] = {}
+        lines = ["digraph calls {", "    node [shape=box];"]
+        for (caller, callee), edge in self.get_call_graph().items():
+            for func in (caller, callee):
+                if func not in node_ids:
+                    node_ids[func] = f"n{len(node_ids)}"
+                    label = self._function_name(func).replace('"', '\\"')
+                    lines.append(f'    {node_ids[func]} [label="{label}"];')
+            lines.append(
+                f'    {node_ids[caller]} -> {node_ids[callee]} '
+                f'[label="{edge.call_count} calls\\n{edge.total_time:.6f} s total\\n'
+                f'{edge.self_time:.6f} s self"];'
+            )
+        lines.append("}")
+        return "\n".join(lines)
+
+    def export_folded_stacks(self, output: Union[str, TextIO]) -> None:
+        """
+        Write the call paths in the folded stack format of Brendan Gregg's
+        FlameGraph tools, one "outer;inner;leaf <self ns>" line per path,
+        e.g. for `flamegraph.pl --countname=ns`.
+
+        Lines are written while the call path tree is walked, so the output
+        is never built up in memory.
+
+        Args:
+            output: File path, or a text file opened for writing
+        """
+        with _open_output(output) as file:
+            for path, node in self.iter_call_paths():
+                if node.self_ns > 0:
+                    stack = ";".join(self._full_function_name(func).replace(";", ",") for func in path)
+                    file.write(f"{stack} {node.self_ns}\n")
+
+    def export_speedscope(self, output: Union[str, TextIO], name: str = "FunctionTracer") -> None:
+        """
+        Write the call paths as a speedscope (https://www.speedscope.app)
+        JSON profile, with one weighted sample per path, weighted by its
+        self time in nanoseconds.
+
+        Samples are written while the call path tree is walked; only the
+        frame table and the weights, one per distinct path, are kept until
+        the end of the file.
+
+        Args:
+            output: File path, or a text file opened for writing
+            name: Profile name shown by speedscope
+        """
+        frame_indexes: Dict[Callable, int] = {}
+        frames = []
+        weights = []
+        with _open_output(output) as file:
+            file.write('{"$schema": "https://www.speedscope.app/file-format-schema.json", ')
+            file.write(f'"name": {json.dumps(name)}, "exporter": "FunctionTracer", "activeProfileIndex": 0, ')
+            file.write(f'"profiles": [{{"type": "sampled", "name": {json.dumps(name)}, "unit": "nanoseconds", ')
+            file.write('"startValue": 0, "samples": [')
+            for path, node in self.iter_call_paths():
+                if node.self_ns <= 0:
+                    continue
+                sample = []
+                for func in path:
+                    index = frame_indexes.get(func)
+                    if index is None:
+                        index = frame_indexes[func] = len(frames)
+                        frame = {'name': self._full_function_name(func)}
+                        code = getattr(func, '__code__', None)
+                        if code is not None:
+                            frame['file'] = code.co_filename
+                            frame['line'] = code.co_firstlineno
+                        frames.append(frame)
+                    sample.append(index)
+                file.write(("," if weights else "") + json.dumps(sample))
+                weights.append(node.self_ns)
+            file.write(f'], "weights": {json.dumps(weights)}, "endValue": {sum(weights)}}}], ')
+            file.write(f'"shared": {{"frames": {json.dumps(frames)}}}}}\n')
+
+    def instrument_asyncio(self, loop: Any = None) -> None:
+        """
+        Account for the asyncio tasks running traced coroutines, until
+        tracing is disabled. Each task's lifetime is split into running,
+        awaiting and queued time, see FunctionStats.task_*.
+
+        A task factory wraps the coroutine of every new task whose coroutine
+        function is traced, and the loop's call_soon() is wrapped to note when
+        such a task is scheduled to run again. That costs one Python call for
+        every callback the loop schedules, and a few clock reads per step of
+        the instrumented tasks.
+
+        Args:
+            loop: Event loop to instrument, the running loop if None
+        """
+        import asyncio
+        if loop is None:
+            loop = asyncio.get_running_loop()
+
+        previous_factory = loop.get_task_factory()
+        original_call_soon = loop.call_soon
+        perf_counter_ns = time.perf_counter_ns
+
+        def task_factory(loop, coro, **kwargs):
+            func = self._code_index.get(getattr(coro, 'cr_code', None))
+            if func is not None and self._enabled:
+                coro = _TaskCoroutine(coro, self, func)
+            if previous_factory is not None:
+                return previous_factory(loop, coro, **kwargs)
+            return asyncio.Task(coro, loop=loop, **kwargs)
+
+        def call_soon(callback, *args, context=None):
+            # Task steps and wakeups are methods bound to the task
+            get_coro = getattr(getattr(callback, '__self__', None), 'get_coro', None)
+            if get_coro is not None:
+                coro = get_coro()
+                if type(coro) is _TaskCoroutine and not coro.ready_ns:
+                    coro.ready_ns = perf_counter_ns()
+            return original_call_soon(callback, *args, context=context)
+
+        loop.set_task_factory(task_factory)
+        loop.call_soon = call_soon
+        self._asyncio_loops.append((loop, previous_factory))
+
+    def _uninstrument_asyncio(self) -> None:
+        """Restore the task factory and call_soon() of instrumented event loops."""
+        for loop, previous_factory in self._asyncio_loops:
+            try:
+                loop.set_task_factory(previous_factory)
+                loop.__dict__.pop('call_soon', None)
+            except Exception as e:
+                print(f"Warning: Could not restore event loop {loop!r}: {e}")
+        self._asyncio_loops.clear()
+
+    @property
+    def timeline(self) -> Optional[TimelineBuffer]:
+        """Buffer of the most recent timed calls, None unless timeline_capacity was set."""
+        return self._timeline
+
+    def export_chrome_trace(self, output: Union[str, TextIO]) -> None:
+        """
+        Write the calls kept in the timeline buffer in the Chrome trace event
+        JSON format, which chrome://tracing and the Perfetto UI
+        (https://ui.perfetto.dev) open directly. Each call is one complete
+        ('X') event on the track of the thread that made it.
+
+        Events are written one at a time straight from the buffer.
+
+        Args:
+            output: File path, or a text file opened for writing
+        """
+        if self._timeline is None:
+            raise RuntimeError("No timeline is recorded, see FunctionTracer(timeline_capacity=...)")
+
+        pid = os.getpid()
+        names: Dict[int, str] = {}
+        with self._shards_lock:
+            threads = [thread for thread, _, _, _ in self._shards]
+
+        with _open_output(output) as file:
+            file.write('{"displayTimeUnit": "ns", "traceEvents": [\n')
+            separator = ""
+            for thread in threads:
+                if thread.ident is not None:
+                    event = {'ph': 'M', 'name': 'thread_name', 'pid': pid, 'tid': thread.ident,
+                             'args': {'name': thread.name}}
+                    file.write(separator + json.dumps(event))
+                    separator = ",\n"
+            for function_id, thread_id, start_ns, duration_ns in self._timeline.events():
+                name = names.get(function_id)
+                if name is None:
+                    node = self._function_nodes[function_id]
+                    name = names[function_id] = self._full_function_name(self._node_functions.get(node, node))
+                event = {'ph': 'X', 'cat': 'function', 'name': name,
+                         'pid': pid, 'tid': thread_id,
+                         'ts': start_ns / 1000, 'dur': duration_ns / 1000}
+                file.write(separator + json.dumps(event))
+                separator = ",\n"
+            file.write("\n]}\n")
+
+    def _apply_calibration(self) -> None:
+        """Use the calibration of the installed engine, measuring it if needed."""
+        key = (self._active_engine, self._native_hook is not None)
+        calibration = self._calibrations.get(key)
+        if calibration is None:
+            calibration = self._run_calibration()
+            self._calibrations[key] = calibration
+
+        self._calibration = calibration
+        self._hook_overhead_ns = calibration.hook_overhead_ns
+        self._clock_overhead_ns = calibration.clock_overhead_ns
+        self._hidden_overhead_ns = max(0, calibration.event_cost_ns - calibration.hook_overhead_ns)
+        self._event_cost_ns = calibration.event_cost_ns
+        self._count_cost_ns = calibration.count_cost_ns
+
+    def _run_calibration(self) -> Calibration:
+        """
+        Measure the tracer's overhead by tracing an empty function.
+
+        The duration recorded for an empty call, minus what the same call
+        costs untraced, is the tracer time that ends up inside every measured
+        duration. Timing whole loops of traced, counted-only and untraced calls
+        gives the cost each call adds for its caller, of which the part
+        outside the measured duration is also removed from traced callers.
+
+        Returns:
+            Calibration for the currently installed engine
+        """
+        perf_counter_ns = time.perf_counter_ns
+        rounds = _CALIBRATION_ROUNDS
+
+        # Baselines are measured without hooks, which would otherwise fire
+        # for the untraced calls and, with the profile engine, the clock reads
+        engine = self._active_engine
+        if engine is not None:
+            self._remove_hooks()
+        try:
+            samples = []
+            for _ in range(rounds):
+                start_time = perf_counter_ns()
+                samples.append(perf_counter_ns() - start_time)
+            clock_overhead = int(statistics.median(samples))
+
+            samples = []
+            for _ in range(rounds):
+                start_time = perf_counter_ns()
+                _calibration_target()
+                samples.append(perf_counter_ns() - start_time)
+            untraced_ns = statistics.median(samples) - clock_overhead
+
+            start_time = perf_counter_ns()
+            for _ in range(rounds):
+                _calibration_target()
+            untraced_loop = perf_counter_ns() - start_time
+        finally:
+            if engine is not None:
+                self._install_hooks()
+
+        if engine is None:
+            # Only wrappers time calls: two clock reads per timed call
+            return Calibration(None, clock_overhead, 0, 2 * clock_overhead, 0)
+
+        code = _calibration_target.__code__
+        saved = (self._overhead_budget, self._hook_overhead_ns, self._hidden_overhead_ns,
+                 self._timeline, self._event_log)
+        (self._overhead_budget, self._hook_overhead_ns, self._hidden_overhead_ns,
+         self._timeline, self._event_log) = None, 0, 0, None, None
+        self._code_index[code] = _calibration_target
+        if self._active_engine == 'monitoring':
+            self._update_monitored_code()
+        try:
+            stats = self._local.stats[_calibration_target]
+            stats.sample_rate = 1
+
+            start_time = perf_counter_ns()
+            for _ in range(rounds):
+                _calibration_target()
+            traced_loop = perf_counter_ns() - start_time
+            traced_ns = stats.histogram.percentile(50)
+
+            stats.sample_rate = _COUNT_ONLY_RATE
+            start_time = perf_counter_ns()
+            for _ in range(rounds):
+                _calibration_target()
+            counted_loop = perf_counter_ns() - start_time
+        finally:
+            del self._code_index[code]
+            if self._active_engine == 'monitoring':
+                self._update_monitored_code()
+            # Leave no trace of the calibration calls in the results
+            state = self._local
+            state.stats.pop(_calibration_target, None)
+            parent = state.stack[-1] if state.stack else None
+            (parent[6] if parent else state.paths).children.pop(code, None)
+            if parent:
+                state.edges.pop((parent[5], code), None)
+            (self._overhead_budget, self._hook_overhead_ns, self._hidden_overhead_ns,
+             self._timeline, self._event_log) = saved
+
+        return Calibration(
+            engine=self._active_engine,
+            native_hook=self._native_hook is not None,
+            clock_overhead_ns=clock_overhead,
+            hook_overhead_ns=max(0, int(traced_ns - untraced_ns)),
+            event_cost_ns=max(0, (traced_loop - untraced_loop) // rounds),
+            count_cost_ns=max(0, (counted_loop - untraced_loop) // rounds),
+        )
+
+    def _new_stats(self) -> FunctionStats:
+        """Create the stats entry of a function in a thread shard."""
+        sketch = self._sketch_factory() if self._sketch_factory is not None else None
+        return FunctionStats(sketch=sketch, sample_rate=self._sample_rate)
+
+    def _apply_sample_rate(self) -> None:
+        """Reset the sampling rate of stats entries created by an earlier enable()."""
+        with self._shards_lock:
+            shards = [shard for _, shard, _, _ in self._shards]
+            shards.append(self._retired_stats)
+        for shard in shards:
+            for stats in list(shard.values()):
+                stats.sample_rate = self._sample_rate
+
+    def _collect_results(self) -> Dict[Callable, FunctionStats]:
+        """
+        Merge the per-thread stats shards into one result.
+
+        Shards of live threads may be updated while they are read, so the
+        result is a snapshot that can miss calls finishing concurrently.
+        Shards of exited threads are folded into _retired_stats, which keeps
+        the merge cost proportional to the number of live threads.
+        """
+        with self._shards_lock:
+            live_shards = self._retire_shards()
+            results: Dict[Callable, FunctionStats] = {}
+            self._merge_stats(results, self._retired_stats)
+        for _, shard, _, _ in live_shards:
+            self._merge_stats(results, shard)
+        return results
+
+    def _collect_call_graph(self) -> Dict[Tuple[Any, Any], CallEdge]:
+        """Merge the per-thread call edges into one result, see _collect_results()."""
+        with self._shards_lock:
+            live_shards = self._retire_shards()
+            edges: Dict[Tuple[Any, Any], CallEdge] = {}
+            self._merge_edges(edges, self._retired_edges)
+        for _, _, shard_edges, _ in live_shards:
+            self._merge_edges(edges, shard_edges)
+        return edges
+
+    def _collect_call_paths(self) -> CallPathNode:
+        """Merge the per-thread call path trees into one, see _collect_results()."""
+        with self._shards_lock:
+            live_shards = self._retire_shards()
+            root = CallPathNode()
+            root.merge(self._retired_paths)
+        for _, _, _, paths in live_shards:
+            root.merge(paths)
+        return root
+
+    def _retire_shards(self, all_threads: bool = False) -> List[_Shard]:
+        """
+        Fold the shards of exited threads into the retired stats, edges and
+        call paths.
+        Must be called with _shards_lock held.
+
+        Args:
+            all_threads: Fold the shards of live threads as well
+
+        Returns:
+            The shards of threads that are still alive, and kept
+        """
+        live_shards = []
+        for thread, shard, edges, paths in self._shards:
+            if thread.is_alive() and not all_threads:
+                live_shards.append((thread, shard, edges, paths))
+            else:
+                self._merge_stats(self._retired_stats, shard)
+                self._merge_edges(self._retired_edges, edges)
+                self._retired_paths.merge(paths)
+        self._shards[:] = live_shards
+        return live_shards
+
+    @staticmethod
+    def _merge_stats(target: Dict[Callable, FunctionStats],
+                     source: Dict[Callable, FunctionStats]) -> None:
+        """Add every entry of a stats dict to another one."""
+        for func, stats in list(source.items()):
+            if stats.call_count == 0 and stats.task_count == 0:
+                continue
+            if func not in target:
+                target[func] = FunctionStats()
+            target[func].merge(stats)
+
+    @staticmethod
+    def _merge_edges(target: Dict[Tuple[Any, Any], CallEdge],
+                     source: Dict[Tuple[Any, Any], CallEdge]) -> None:
+        """Add every call edge of a dict to another one."""
+        for key, edge in list(source.items()):
+            if key not in target:
+                target[key] = CallEdge()
+            target[key].merge(edge)
+
+    def _timed_wrapper(self, function: Callable) -> Callable:
+        """
+        Wrap a function so that it records its own timing into the stats
+        shard of the calling thread, used by @FunctionTracer.trace(timed=True)
+        and for built-ins under the settrace and monitoring engines.
+
+        Args:
+            function: Function to time
+
+        Returns:
+            Wrapper timing each sampled call while tracing is enabled, with
+            two clock reads and no interpreter hook
+        """
+        perf_counter_ns = time.perf_counter_ns
+        node = getattr(function, '__code__', function)
+        self._node_functions[node] = function
+        # (stats dict, stats entry, call stack, outermost call path node) of
+        # the thread that called last, so that repeated calls from a thread
+        # skip these lookups. Replaced as a whole, so threads never mix up
+        # each other's entries
+        cache = [(None, None, None, None)]
+
+        @functools.wraps(function)
+        def timed_wrapper(*args, **kwargs):
+            if not self._enabled:
+                return function(*args, **kwargs)
+
+            state = self._local
+            shard = state.stats
+            cached = cache[0]
+            if cached[0] is not shard:
+                cached = cache[0] = (shard, shard[function], state.stack, None)
+            stats = cached[1]
+            stats.call_count += 1
+            if stats.call_count % stats.sample_rate:
+                return function(*args, **kwargs)
+
+            stack = cached[2]
+            if stack or self._timeline is not None or self._event_log is not None:
+                # Called from a traced call: attribute the time to it and to
+                # the call edge between the two, see _pop_call()
+                self._push_call(state, function, stats, node)
+                error = None
+                try:
+                    return function(*args, **kwargs)
+                except BaseException as e:
+                    error = type(e)
+                    raise
+                finally:
+                    self._pop_call(state, function, perf_counter_ns(),
+                                   self._clock_overhead_ns, self._clock_overhead_ns, error=error)
+
+            # Outermost traced call: only its own entry, for traced callees
+            path = cached[3]
+            if path is None:
+                path = state.paths.children.get(node)
+                if path is None:
+                    path = state.paths.children[node] = CallPathNode(node)
+                cache[0] = (shard, stats, stack, path)
+            entry = [function, stats, 0, 0, 0, node, path, None, None]
+            stack.append(entry)
+            error = None
+            start_time = entry[2] = perf_counter_ns()
+            try:
+                return function(*args, **kwargs)
+            except BaseException as e:
+                error = type(e)
+                raise
+            finally:
+                end_time = perf_counter_ns()
+                if stack and stack[-1] is entry:
+                    del stack[-1]
+                    elapsed = end_time - start_time - self._clock_overhead_ns
+                    duration = elapsed - entry[4]
+                    if duration < 0:
+                        duration = 0
+                    self_duration = elapsed - entry[3]
+                    if self_duration < 0:
+                        self_duration = 0
+                    self._record(stats, duration, self_duration, error)
+                    path.call_count += 1
+                    path.total_ns += duration
+                    path.self_ns += self_duration
+                else:
+                    self._pop_call(state, function, end_time, self._clock_overhead_ns,
+                                   self._clock_overhead_ns, error=error)
+
+        return timed_wrapper
+
+    def _needs_hooks(self) -> bool:
+        """Check whether any traced function requires an interpreter hook."""
+        if self._code_index:
+            return True
+        return self.engine == 'profile' and bool(self._builtin_functions)
+
+    def _rebuild_code_index(self) -> None:
+        """
+        Rebuild the mapping from code objects to traced functions, so that
+        'call' events are dispatched with a single dict lookup.
+        """
+        self._code_index = {
+            func.__code__: func
+            for func in self._traced_functions
+            if hasattr(func, '__code__')
+        }
+        self._node_functions.update(self._code_index)
+        if self._native_hook is not None:
+            self._native_hook.code_index = self._code_index
+
+    def _install_hooks(self) -> None:
+        """Install the interpreter hook for the selected engine."""
+        if self.engine == 'monitoring':
+            if self._start_monitoring():
+                self._active_engine = 'monitoring'
+                return
+            if self._engine == 'monitoring':
+                raise RuntimeError("sys.monitoring profiler tool id is already in use")
+            # Another tool owns the profiler slot, fall back to settrace
+
+        if self.engine == 'profile':
+            self._original_profile_function = sys.getprofile()
+            self._thread_profile_function = threading.getprofile()
+            if self._accelerate:
+                self._native_hook = _tracer_speedups.ProfileHook(
+                    self._profile_function, self._code_index, self._builtin_functions, tracer=self)
+                # Threads started later call it once as a profile function,
+                # which installs it natively in them
+                threading.setprofile(self._native_hook)
+                self._native_hook.install(all_threads=True)
+            else:
+                self._set_profile_all_threads(self._profile_function)
+            self._active_engine = 'profile'
+            return
+
+        self._original_trace_function = sys.gettrace()
+        self._thread_trace_function = threading.gettrace()
+        self._set_trace_all_threads(self._trace_function)
+        self._active_engine = 'settrace'
+
+    def _remove_hooks(self) -> None:
+        """Remove the interpreter hook installed by _install_hooks()."""
+        if self._active_engine == 'monitoring':
+            self._stop_monitoring()
+        elif self._active_engine == 'profile':
+            self._set_profile_all_threads(self._original_profile_function)
+            self._original_profile_function = None
+            self._native_hook = None
+        else:
+            self._set_trace_all_threads(self._original_trace_function)
+            self._original_trace_function = None
+        self._active_engine = None
+
+    @staticmethod
+    def _set_trace_all_threads(trace_function: Optional[Callable]) -> None:
+        """
+        Install a trace function in the current thread and in threads started
+        afterwards. On Python 3.12+ already running threads are covered too.
+        """
+        if hasattr(threading, 'settrace_all_threads'):
+            threading.settrace_all_threads(trace_function)
+        else:
+            sys.settrace(trace_function)
+            threading.settrace(trace_function)
+
+    @staticmethod
+    def _set_profile_all_threads(profile_function: Optional[Callable]) -> None:
+        """Profile hook counterpart of _set_trace_all_threads()."""
+        if hasattr(threading, 'setprofile_all_threads'):
+            threading.setprofile_all_threads(profile_function)
+        else:
+            sys.setprofile(profile_function)
+            threading.setprofile(profile_function)
+
+    def _start_monitoring(self) -> bool:
+        """
+        Register sys.monitoring callbacks for the traced code objects.
+
+        Returns:
+            True on success, False if the profiler tool id is taken
+        """
+        monitoring = sys.monitoring
+        tool_id = monitoring.PROFILER_ID
+        try:
+            monitoring.use_tool_id(tool_id, "FunctionTracer")
+        except ValueError:
+            return False
+
+        events = monitoring.events
+        monitoring.register_callback(tool_id, events.PY_START, self._monitor_start)
+        monitoring.register_callback(tool_id, events.PY_RETURN, self._monitor_return)
+        monitoring.register_callback(tool_id, events.PY_UNWIND, self._monitor_unwind)
+        monitoring.register_callback(tool_id, events.PY_RESUME, self._monitor_resume)
+        monitoring.register_callback(tool_id, events.PY_THROW, self._monitor_resume)
+        monitoring.register_callback(tool_id, events.PY_YIELD, self._monitor_yield)
+        # PY_UNWIND and PY_THROW cannot be enabled per code object; they only
+        # fire while an exception propagates, so enabling them globally is cheap
+        monitoring.set_events(tool_id, events.PY_UNWIND | events.PY_THROW)
+        self._update_monitored_code()
+        return True
+
+    def _stop_monitoring(self) -> None:
+        """Unregister all sys.monitoring callbacks and release the tool id."""
+        monitoring = sys.monitoring
+        tool_id = monitoring.PROFILER_ID
+        events = monitoring.events
+
+        for code in self._monitored_codes:
+            monitoring.set_local_events(tool_id, code, 0)
+        self._monitored_codes.clear()
+
+        monitoring.set_events(tool_id, 0)
+        for event in (events.PY_START, events.PY_RETURN, events.PY_UNWIND,
+                      events.PY_RESUME, events.PY_THROW, events.PY_YIELD):
+            monitoring.register_callback(tool_id, event, None)
+        monitoring.free_tool_id(tool_id)
+
+    def _update_monitored_code(self) -> None:
+        """Enable local events on traced code objects and clear stale ones."""
+        monitoring = sys.monitoring
+        tool_id = monitoring.PROFILER_ID
+        events = monitoring.events
+
+        for code in self._monitored_codes - self._code_index.keys():
+            monitoring.set_local_events(tool_id, code, 0)
+        for code in self._code_index.keys() - self._monitored_codes:
+            local_events = events.PY_START | events.PY_RETURN
+            if code.co_flags & _SUSPENDABLE_FLAGS:
+                local_events |= events.PY_RESUME | events.PY_YIELD
+            monitoring.set_local_events(tool_id, code, local_events)
+        self._monitored_codes = set(self._code_index)
 
     def _is_builtin_function(self, func: Callable) -> bool:
         """
@@ -176,24 +1854,7 @@ class FunctionTracer:
                 continue
 
             self._original_builtins[func] = func
-
-            @functools.wraps(func)
-            def wrapped_function(*args, **kwargs):
-                if not self._enabled:
-                    return func(*args, **kwargs)
-
-                start_time = time.perf_counter()
-                result = func(*args, **kwargs)
-                duration = time.perf_counter() - start_time
-
-                stats = self._stats[func]
-                stats.call_count += 1
-                stats.total_time += duration
-                stats.min_time = min(stats.min_time, duration)
-                stats.max_time = max(stats.max_time, duration)
-
-                return result
-
+            wrapped_function = self._timed_wrapper(func)
             self._wrapped_builtins[func] = wrapped_function
 
             if hasattr(func, '__module__') and hasattr(func, '__name__'):
@@ -227,49 +1888,545 @@ class FunctionTracer:
 
     def _trace_function(self, frame, event, arg) -> Optional[Callable]:
         """
-        Trace function that will be registered with sys.settrace().
+        Global trace function that will be registered with sys.settrace().
 
         Args:
             frame: Current execution frame
-            event: Event type ('call', 'return', 'line', 'exception')
+            event: Event type, always 'call' for the global trace function
             arg: Event-specific argument
 
         Returns:
-            Self if the function should be traced, None otherwise
+            _trace_local if the function should be traced, None otherwise
         """
+        if not self._enabled:
+            # Before 3.12 disable() only removes the hook from its own thread,
+            # threads started while tracing put back the one they would have had
+            sys.settrace(self._thread_trace_function)
+            return None
+
         try:
             if event == 'call':
                 # A function is being called
-                func = None
                 code = frame.f_code
+                func = self._code_index.get(code)
 
-                for traced_func in self._traced_functions:
-                    if hasattr(traced_func, '__code__') and traced_func.__code__ is code:
-                        func = traced_func
-                        break
+                if func is not None:
+                    state = self._local
+                    if code.co_flags & _SUSPENDABLE_FLAGS:
+                        # Every resumption arrives as a 'call', and even untimed
+                        # invocations need their final 'return' to be seen
+                        self._resume_invocation(state, frame, frame, code, func)
+                        frame.f_trace_lines = False
+                        return self._trace_local
+
+                    stats = state.stats[func]
+                    stats.call_count += 1
+                    if stats.call_count % stats.sample_rate:
+                        # Not sampled, but its traced callees must still find
+                        # their caller on the stack, and its 'return' the entry
+                        stats = None
+
+                    self._push_call(state, frame, stats, code)
+                    # Only the 'return' event is needed from this frame, so
+                    # stop CPython from delivering one event per executed line
+                    frame.f_trace_lines = False
+                    return self._trace_local
+        except Exception as e:
+            print(f"Tracing error: {e}")
+
+        return None
+
+    def _trace_local(self, frame, event, arg) -> Optional[Callable]:
+        """
+        Local trace function installed on traced frames by _trace_function().
+
+        Args:
+            frame: Current execution frame
+            event: Event type ('return' or 'exception')
+            arg: Event-specific argument
+
+        Returns:
+            Self, so that the frame keeps delivering its 'return' event
+        """
+        if not self._enabled:
+            return None
+
+        try:
+            if event == 'return':
+                end_time = time.perf_counter_ns()
+                state = self._local
+                stack = state.stack
+                if stack and stack[-1][0] is frame and stack[-1][1] is None:
+                    self._pop_call(state, frame, 0, 0, 0)
+                    return self._trace_local
+                # An exception propagating out of the frame returns None
+                error = self._unwinding_error(state, frame) if arg is None else None
+                if frame.f_code.co_flags & _SUSPENDABLE_FLAGS:
+                    self._return_from_invocation(state, frame, end_time, error=error)
+                else:
+                    self._pop_call(state, frame, end_time, self._hook_overhead_ns,
+                                   self._hidden_overhead_ns, error=error)
+
+            elif event == 'exception':
+                # Remember the type, in case the exception propagates out of the frame
+                stack = self._local.stack
+                if stack and stack[-1][0] is frame:
+                    stack[-1][8] = arg[0]
+        except Exception as e:
+            print(f"Tracing error: {e}")
+
+        return self._trace_local
+
+    def _profile_function(self, frame, event, arg) -> None:
+        """
+        Profile function that will be registered with sys.setprofile().
 
+        Unlike the settrace engine, built-in functions are timed from the
+        'c_call'/'c_return' events, so they don't need to be monkeypatched.
+        Only built-ins called directly from Python code produce these events.
+
+        Args:
+            frame: Current execution frame
+            event: Event type ('call', 'return', 'c_call', 'c_return', 'c_exception')
+            arg: The called built-in for 'c_*' events, return value for 'return'
+        """
+        if not self._enabled:
+            # See _trace_function()
+            sys.setprofile(self._thread_profile_function)
+            return
+
+        try:
+            if event == 'call':
+                code = frame.f_code
+                func = self._code_index.get(code)
                 if func is not None:
-                    thread_id = id(frame)
-                    self._call_stack[thread_id] = (func, time.perf_counter())
-                    return self._trace_function
+                    state = self._local
+                    if code.co_flags & _SUSPENDABLE_FLAGS:
+                        self._resume_invocation(state, frame, frame, code, func)
+                        return
+                    stats = state.stats[func]
+                    stats.call_count += 1
+                    if stats.call_count % stats.sample_rate:
+                        # Not sampled, but its 'return' must still find its entry
+                        stats = None
+                    self._push_call(state, frame, stats, code)
 
             elif event == 'return':
-                thread_id = id(frame)
-                if thread_id in self._call_stack:
-                    # It's a function we're tracing
-                    func, start_time = self._call_stack.pop(thread_id)
-                    duration = time.perf_counter() - start_time
-
-                    # Update stats
-                    stats = self._stats[func]
+                # Every Python return arrives here, only the top entry can match
+                state = self._local
+                if state.stack and state.stack[-1][0] is frame:
+                    if state.stack[-1][1] is None:
+                        self._pop_call(state, frame, 0, 0, 0)
+                        return
+                    end_time = time.perf_counter_ns()
+                    error = self._unwinding_error(state, frame) if arg is None else None
+                    if state.stack[-1][7] is not None:
+                        self._return_from_invocation(state, frame, end_time, error=error)
+                    else:
+                        self._pop_call(state, frame, end_time, self._hook_overhead_ns,
+                                       self._hidden_overhead_ns, error=error)
+                elif self._invocations and frame.f_code.co_flags & _SUSPENDABLE_FLAGS:
+                    # Untimed invocations have no stack entry
+                    error = self._unwinding_error(state, frame) if arg is None else None
+                    self._return_from_invocation(state, frame, 0, error=error)
+                elif state.stack and frame.f_code in self._code_index:
+                    # Every traced call has an entry, so the entries above
+                    # this one missed their 'return', see _pop_call()
+                    self._pop_call(state, frame, time.perf_counter_ns(), self._hook_overhead_ns,
+                                   self._hidden_overhead_ns, error=self._unwinding_error(state, frame))
+
+            elif event == 'c_call':
+                if arg in self._builtin_functions:
+                    state = self._local
+                    stats = state.stats[arg]
                     stats.call_count += 1
-                    stats.total_time += duration
-                    stats.min_time = min(stats.min_time, duration)
-                    stats.max_time = max(stats.max_time, duration)
+                    if stats.call_count % stats.sample_rate == 0:
+                        self._push_call(state, arg, stats, arg)
+
+            else:  # 'c_return' or 'c_exception'
+                state = self._local
+                if state.stack and state.stack[-1][0] is arg:
+                    # The profile hook is not told the type of the exception
+                    error = BaseException if event == 'c_exception' else None
+                    self._pop_call(state, arg, time.perf_counter_ns(), self._hook_overhead_ns,
+                                   self._hidden_overhead_ns, error=error)
         except Exception as e:
             print(f"Tracing error: {e}")
 
-        return None
+    def _push_call(self, state: _ThreadState, key: Any, stats: Optional[FunctionStats],
+                   node: Any, invocation: Optional[list] = None) -> None:
+        """
+        Start a call on a thread's stack, one step down the call path tree
+        from the enclosing traced call.
+
+        Args:
+            state: Tracer state of the current thread
+            key: Object identifying the call when it returns: the frame, the
+                 code object or the callable
+            stats: Stats entry of the function, None if the call is not timed,
+                   in which case the entry only marks the call and the clock
+                   is not read
+            node: Code object of the function, or the built-in itself
+            invocation: Generator or coroutine invocation being resumed
+        """
+        stack = state.stack
+        parent_path = stack[-1][6] if stack else state.paths
+        path = parent_path.children.get(node)
+        if path is None:
+            path = parent_path.children[node] = CallPathNode(node)
+        start_time = time.perf_counter_ns() if stats is not None else 0
+        stack.append([key, stats, start_time, 0, 0, node, path, invocation, None])
+
+    @staticmethod
+    def _unwinding_error(state: _ThreadState, frame: Any) -> Optional[type]:
+        """
+        Tell whether a frame delivering a 'return' event with a None value
+        is unwinding on an exception, from the instruction it stopped at.
+
+        Args:
+            state: Tracer state of the current thread
+            frame: Frame that is returning
+
+        Returns:
+            Type of the exception, as noted by the last 'exception' event of
+            the frame, BaseException if that was not seen (the profile engine
+            gets no such events), or None for a normal return
+        """
+        offset = frame.f_lasti
+        if offset < 0 or frame.f_code.co_code[offset] in _RETURN_OPS:
+            return None
+        stack = state.stack
+        if stack and stack[-1][0] is frame and stack[-1][8] is not None:
+            return stack[-1][8]
+        return BaseException
+
+    def _pop_call(self, state: _ThreadState, key: Any, end_time: int, overhead_ns: int,
+                  hidden_ns: int, suspended: bool = False, error: Optional[type] = None) -> None:
+        """
+        Finish the innermost call on a thread's stack that was started for key,
+        record it and attribute its time to the traced call below it, and to
+        the call edge between the two.
+
+        The caller's child_ns collects the full window of the call plus the
+        tracer time spent outside it, so that subtracting it leaves the
+        caller's self time. nested_overhead_ns collects only tracer time,
+        which is removed from the caller's inclusive time as well.
+
+        A generator or coroutine entry only covers one resumption of its
+        invocation. Its time is added to the invocation, which is recorded
+        as one call when it finally returns.
+
+        The entry is normally on top of the stack, so this is O(1). Entries
+        above it are stale: their calls exited without a return event, e.g.
+        while another tool had replaced the interpreter hook. They are
+        dropped, so that they can neither be matched by a later call for
+        the same key nor collect the time of later calls.
+
+        Args:
+            state: Tracer state of the current thread
+            key: Frame, code object or callable the entry was pushed for
+            end_time: perf_counter_ns() when the call returned
+            overhead_ns: Tracer time included in the measured duration
+            hidden_ns: Tracer time the call costs its caller outside the
+                       measured duration
+            suspended: The generator or coroutine yielded, and will resume
+            error: Type of the exception the call raised, None if it returned
+        """
+        stack = state.stack
+        index = len(stack) - 1
+        if index < 0:
+            return
+        if stack[index][0] is not key:
+            while index >= 0 and stack[index][0] is not key:
+                index -= 1
+            if index < 0:
+                # Not started while this thread's stack was recorded
+                return
+            state.stale_entries += len(stack) - index - 1
+            del stack[index + 1:]
+
+        _, stats, start_time, child_ns, nested_ns, node, path, invocation, _ = stack.pop()
+        parent = stack[-1] if stack else None
+        if stats is None:
+            # Not timed: its traced callees are attributed to the caller
+            if parent is not None:
+                parent[3] += child_ns
+                parent[4] += nested_ns
+            return
+
+        elapsed = end_time - start_time
+        duration = elapsed - overhead_ns - nested_ns
+        if duration < 0:
+            duration = 0
+        self_duration = elapsed - overhead_ns - child_ns
+        if self_duration < 0:
+            self_duration = 0
+        if invocation is None:
+            self._record(stats, duration, self_duration, error)
+        elif suspended:
+            invocation[2] += duration
+            invocation[3] += self_duration
+        else:
+            wall_ns = end_time - invocation[1] - overhead_ns
+            stats.wall_ns += wall_ns
+            self._record(stats, invocation[2] + duration, invocation[3] + self_duration, error)
+            if error is not None:
+                stats.exceptions[error].wall_ns += wall_ns
+        if not suspended:
+            path.call_count += 1
+        path.total_ns += duration
+        path.self_ns += self_duration
+        if self._timeline is not None or self._event_log is not None:
+            function_id = self._function_ids.get(node)
+            if function_id is None:
+                function_id = self._function_id(node)
+            if self._timeline is not None:
+                self._timeline.record(function_id, state.thread_id, start_time, duration)
+            if self._event_log is not None:
+                self._event_log.record(function_id, state.thread_id, start_time, duration)
+
+        if parent is not None:
+            parent[3] += elapsed + hidden_ns
+            parent[4] += nested_ns + overhead_ns + hidden_ns
+            edge = state.edges[(parent[5], node)]
+            if not suspended:
+                edge.call_count += 1
+            edge.total_ns += duration
+            edge.self_ns += self_duration
+
+    def _resume_invocation(self, state: _ThreadState, frame: Any, key: Any,
+                           code: CodeType, func: Callable, started: Optional[bool] = None) -> None:
+        """
+        Start or resume a generator or coroutine invocation. Only its first
+        start is counted as a call and decides whether it is timed.
+
+        Invocations are keyed by id(frame), which keeps no frame alive. A
+        frame id reused by a new invocation is recognized by its first start,
+        which replaces whatever was left behind under that id.
+
+        Args:
+            state: Tracer state of the current thread
+            frame: Frame of the invocation, the same across resumptions
+            key: Stack entry key, see _push_call()
+            code: Code object of the generator or coroutine function
+            func: Traced function
+            started: Whether this is the first start, if the event says so;
+                     None to tell from the instruction it starts at
+        """
+        offset = frame.f_lasti
+        co_code = code.co_code
+        if started is None:
+            started = offset < 0 or (co_code[offset] == _RESUME and co_code[offset + 1] == 0)
+
+        invocations = self._invocations
+        frame_id = id(frame)
+        invocation = None if started else invocations.get(frame_id)
+        if invocation is None:
+            stats = state.stats[func]
+            stats.call_count += 1
+            if stats.call_count % stats.sample_rate:
+                stats = None
+            invocation = invocations[frame_id] = [stats, 0, 0, 0, -1]
+            if len(invocations) > _MAX_INVOCATIONS:
+                del invocations[next(iter(invocations))]
+
+        # throw() and close() resume at the yield itself on 3.11 and 3.12. If
+        # the exception escapes, the frame returns at that same offset without
+        # a value, see _return_from_invocation(). 3.10 resumes there from every
+        # send(), so an escaping exception looks like a suspension and the
+        # invocation is never timed.
+        invocation[4] = offset if _RESUME >= 0 and offset >= 0 and co_code[offset] == _YIELD_VALUE else -1
+
+        if invocation[0] is not None:
+            self._push_call(state, key, invocation[0], code, invocation)
+            if invocation[1] == 0:
+                invocation[1] = state.stack[-1][2]
+
+    def _return_from_invocation(self, state: _ThreadState, frame: Any, end_time: int,
+                                suspended: Optional[bool] = None, error: Optional[type] = None) -> None:
+        """
+        Handle a generator or coroutine frame returning, either suspended at
+        a yield or await, or finished.
+
+        Args:
+            state: Tracer state of the current thread
+            frame: Frame of the invocation
+            end_time: perf_counter_ns() when the frame returned
+            suspended: Whether the frame was suspended, if the event says so;
+                       None to tell from the instruction it returned at
+            error: Type of the exception the frame is unwinding on, if any.
+                   Engines telling suspension from the instruction pass the
+                   _unwinding_error() of frames returning None.
+        """
+        frame_id = id(frame)
+        invocation = self._invocations.get(frame_id)
+        if invocation is None:
+            return
+        if suspended is None:
+            # Returning at the yield throw() resumed it at is only a suspension
+            # if a value was yielded: an escaping exception returns None there.
+            # A generator catching it and yielding None looks finished.
+            offset = frame.f_lasti
+            co_code = frame.f_code.co_code
+            suspended = offset >= 0 and (offset != invocation[4] or error is None) and (
+                co_code[offset] == _YIELD_VALUE
+                or (co_code[offset] == _RESUME and co_code[offset + 1] != 0)
+                or (offset + 2 < len(co_code) and co_code[offset + 2] == _YIELD_FROM))
+        if not suspended:
+            del self._invocations[frame_id]
+        if error is GeneratorExit or error is BaseException:
+            # close() is the normal way to abandon a generator, not a failure.
+            # Without the type (profile engine) an unwind is most likely that.
+            error = None
+        if invocation[0] is not None:
+            key = frame if self._active_engine != 'monitoring' else frame.f_code
+            self._pop_call(state, key, end_time, self._hook_overhead_ns,
+                           self._hidden_overhead_ns, suspended, None if suspended else error)
+
+    def _function_id(self, node: Any) -> int:
+        """Assign the function id under which a node is stored in the timeline and event log."""
+        with self._function_ids_lock:
+            function_id = self._function_ids.get(node)
+            if function_id is None:
+                # Publish the node before its id, the export looks it up by id
+                function_id = len(self._function_nodes)
+                self._function_nodes.append(node)
+                if self._event_log is not None:
+                    name = self._full_function_name(self._node_functions.get(node, node))
+                    self._event_log.add_function(function_id, name)
+                self._function_ids[node] = function_id
+            return function_id
+
+    def _record(self, stats: FunctionStats, duration: int, self_duration: int,
+                error: Optional[type] = None) -> None:
+        """
+        Add one timed call to the statistics of a function. The call itself
+        was already counted when it started.
+
+        Args:
+            stats: Stats entry of the function in the current thread's shard
+            duration: Execution time of the call in nanoseconds, after
+                      subtracting the calibrated tracer overhead
+            self_duration: Part of duration not spent in timed callees
+            error: Type of the exception the call raised, None if it returned
+        """
+        stats.timed_count += 1
+        stats.total_ns += duration
+        stats.self_ns += self_duration
+        if duration < stats.min_ns:
+            stats.min_ns = duration
+        if duration > stats.max_ns:
+            stats.max_ns = duration
+        stats.histogram.record(duration)
+        if stats.sketch is not None:
+            stats.sketch.add(duration)
+
+        if error is not None:
+            if stats.exceptions is None:
+                stats.exceptions = {}
+            error_stats = stats.exceptions.get(error)
+            if error_stats is None:
+                error_stats = stats.exceptions[error] = FunctionStats()
+            error_stats.call_count += 1
+            error_stats.timed_count += 1
+            error_stats.total_ns += duration
+            error_stats.self_ns += self_duration
+            if duration < error_stats.min_ns:
+                error_stats.min_ns = duration
+            if duration > error_stats.max_ns:
+                error_stats.max_ns = duration
+            error_stats.histogram.record(duration)
+
+        if self._overhead_budget is not None and stats.timed_count % _GOVERNOR_INTERVAL == 0:
+            self._govern(stats)
+
+    def _govern(self, stats: FunctionStats) -> None:
+        """
+        Overhead governor: choose how a function is measured so that the
+        tracer's cost stays within the overhead budget. Runs every
+        _GOVERNOR_INTERVAL timed calls, on the thread's own shard, so it needs
+        no locking.
+
+        Every call costs _count_cost_ns and each timed call _event_cost_ns
+        more, so with 1-in-N sampling the overhead per call is about
+        count_cost + event_cost / N. N is the smallest rate keeping that under
+        budget * mean duration. If no rate up to _MAX_SAMPLE_RATE does, the
+        function is demoted to counting only and is never timed again.
+
+        Args:
+            stats: Stats entry of the function in the current thread's shard
+        """
+        mean_ns = stats.total_ns / stats.timed_count
+        spare_ns = self._overhead_budget * mean_ns - self._count_cost_ns
+        if spare_ns <= 0 or self._event_cost_ns / spare_ns > _MAX_SAMPLE_RATE:
+            stats.sample_rate = _COUNT_ONLY_RATE
+            return
+
+        rate = math.ceil(self._event_cost_ns / spare_ns)
+        stats.sample_rate = max(rate, self._sample_rate)
+
+    def _monitor_start(self, code: CodeType, instruction_offset: int) -> None:
+        """sys.monitoring PY_START callback, only fires for traced code."""
+        func = self._code_index.get(code)
+        if func is None:
+            return
+
+        state = self._local
+        if code.co_flags & _SUSPENDABLE_FLAGS:
+            self._resume_invocation(state, sys._getframe(1), code, code, func, started=True)
+            return
+
+        stats = state.stats[func]
+        stats.call_count += 1
+        if stats.call_count % stats.sample_rate:
+            # Not sampled, but PY_RETURN still fires and must find its entry
+            self._push_call(state, code, None, code)
+            return
+        self._push_call(state, code, stats, code)
+
+    def _monitor_resume(self, code: CodeType, instruction_offset: int, *args: Any) -> None:
+        """
+        sys.monitoring PY_RESUME and PY_THROW callback, resuming a suspended
+        generator or coroutine.
+        """
+        func = self._code_index.get(code)
+        if func is not None:
+            self._resume_invocation(self._local, sys._getframe(1), code, code, func, started=False)
+
+    def _monitor_yield(self, code: CodeType, instruction_offset: int, value: Any) -> None:
+        """sys.monitoring PY_YIELD callback, suspending a generator or coroutine."""
+        end_time = time.perf_counter_ns()
+        if code in self._code_index:
+            self._return_from_invocation(self._local, sys._getframe(1), end_time, suspended=True)
+
+    def _monitor_return(self, code: CodeType, instruction_offset: int, arg: Any) -> None:
+        """sys.monitoring PY_RETURN callback."""
+        end_time = time.perf_counter_ns()
+        if code not in self._code_index:
+            return
+        state = self._local
+        if code.co_flags & _SUSPENDABLE_FLAGS:
+            self._return_from_invocation(state, sys._getframe(1), end_time, suspended=False)
+        elif state.stack:
+            self._pop_call(state, code, end_time, self._hook_overhead_ns, self._hidden_overhead_ns)
+
+    def _monitor_unwind(self, code: CodeType, instruction_offset: int, exception: BaseException) -> None:
+        """
+        sys.monitoring PY_UNWIND callback, a frame exiting on an exception.
+
+        PY_UNWIND is delivered for every frame an exception propagates
+        through, so frames that were not started by _monitor_start are ignored.
+        """
+        end_time = time.perf_counter_ns()
+        if code not in self._code_index:
+            return
+        state = self._local
+        if code.co_flags & _SUSPENDABLE_FLAGS:
+            self._return_from_invocation(state, sys._getframe(1), end_time, suspended=False,
+                                         error=type(exception))
+        elif state.stack:
+            self._pop_call(state, code, end_time, self._hook_overhead_ns,
+                           self._hidden_overhead_ns, error=type(exception))
 
     def format_results(self) -> str:
         """
@@ -278,38 +2435,133 @@ class FunctionTracer:
         Returns:
             Formatted results as a string
         """
-        if not self._stats:
+        results = self._collect_results()
+        if not results:
             return "No tracing data collected."
 
-        lines = ["Function Tracing Results:", "-" * 80]
-        header = f"{'Function Name':<40} {'Calls':<10} {'Total (s)':<12} {'Avg (ms)':<12} {'Min (ms)':<12} {'Max (ms)':<12}"
-        lines.append(header)
-        lines.append("-" * 80)
-
-        for func, stats in self._stats.items():
-            # Get a readable function name
-            if callable(func):
-                if hasattr(func, '__name__'):
-                    if hasattr(func, '__module__') and func.__module__ != '__main__':
-                        func_name = f"{func.__module__}.{func.__name__}"
-                    else:
-                        func_name = func.__name__
-                else:
-                    func_name = str(func)
-            else:
-                func_name = str(func)
+        header = (
+            f"{'Function Name':<40} {'Calls':<10} {'Total (s)':<12} {'Self (s)':<12} {'Avg (ms)':<12} {'Min (ms)':<12} "
+            f"{'Max (ms)':<12} {'P50 (ms)':<12} {'P99 (ms)':<12} {'P99.9 (ms)':<12}"
+        )
+        separator = "-" * len(header)
+        lines = ["Function Tracing Results:", separator, header, separator]
 
-            if len(func_name) > 38:
-                func_name = "..." + func_name[-35:]
+        for func, stats in results.items():
+            func_name = self._function_name(func)
 
             line = (
                 f"{func_name:<40} "
                 f"{stats.call_count:<10} "
                 f"{stats.total_time:<12.6f} "
+                f"{stats.self_time:<12.6f} "
                 f"{stats.avg_time * 1000:<12.6f} "
                 f"{stats.min_time * 1000:<12.6f} "
-                f"{stats.max_time * 1000:<12.6f}"
+                f"{stats.max_time * 1000:<12.6f} "
+                f"{stats.percentile(50) * 1000:<12.6f} "
+                f"{stats.percentile(99) * 1000:<12.6f} "
+                f"{stats.percentile(99.9) * 1000:<12.6f}"
             )
             lines.append(line)
 
+        if self._calibration is not None:
+            calibration = self._calibration
+            lines.append("")
+            lines.append(
+                f"Calibration ({calibration.engine or 'wrappers only'}"
+                f"{', native hook' if calibration.native_hook else ''}): "
+                f"{calibration.hook_overhead_ns} ns hook / {calibration.clock_overhead_ns} ns clock "
+                f"overhead subtracted per call, {calibration.event_cost_ns} ns per timed call, "
+                f"{calibration.count_cost_ns} ns per counted call"
+            )
+
+        suspendable = [(func, stats) for func, stats in results.items() if stats.wall_ns > 0]
+        if suspendable:
+            lines.append("")
+            lines.append("Generators and coroutines, per invocation:")
+            for func, stats in suspendable:
+                lines.append(
+                    f"  {self._function_name(func)}: {stats.avg_time * 1000:.6f} ms active, "
+                    f"{stats.wall_ns / stats.timed_count / 1e6:.6f} ms wall"
+                )
+
+        tasks = [(func, stats) for func, stats in results.items() if stats.task_count > 0]
+        if tasks:
+            lines.append("")
+            lines.append("asyncio tasks, per task:")
+            for func, stats in tasks:
+                lines.append(
+                    f"  {self._function_name(func)}: {stats.task_count} tasks, "
+                    f"{stats.task_running_ns / stats.task_count / 1e6:.6f} ms running, "
+                    f"{stats.task_awaited_ns / stats.task_count / 1e6:.6f} ms awaiting, "
+                    f"{stats.task_queued_ns / stats.task_count / 1e6:.6f} ms queued"
+                )
+
+        failing = [(func, stats) for func, stats in results.items() if stats.exceptions]
+        if failing:
+            lines.append("")
+            lines.append("Timed calls by outcome:")
+            for func, stats in failing:
+                successes = stats.successes()
+                lines.append(
+                    f"  {self._function_name(func)}: {successes.timed_count} returned, "
+                    f"{successes.avg_time * 1000:.6f} ms avg, {successes.percentile(99) * 1000:.6f} ms P99"
+                )
+                for error, error_stats in sorted(stats.exceptions.items(),
+                                                 key=lambda item: -item[1].timed_count):
+                    lines.append(
+                        f"    {error.__name__}: {error_stats.timed_count} raised, "
+                        f"{error_stats.avg_time * 1000:.6f} ms avg, "
+                        f"{error_stats.percentile(99) * 1000:.6f} ms P99"
+                    )
+
+        demoted = [(func, stats) for func, stats in results.items()
+                   if stats.sample_rate > self._sample_rate]
+        if demoted:
+            lines.append("")
+            lines.append("Demoted by the overhead governor:")
+            for func, stats in demoted:
+                if stats.mode == 'counted':
+                    lines.append(f"  {self._function_name(func)}: counted only")
+                else:
+                    lines.append(f"  {self._function_name(func)}: timed 1 in {stats.sample_rate} calls")
+
         return "\n".join(lines)
+
+    @staticmethod
+    def _function_name(func: Callable) -> str:
+        """
+        Get a readable name of a traced function for reports.
+
+        Args:
+            func: Traced function
+
+        Returns:
+            Module-qualified name, truncated to 38 characters
+        """
+        func_name = FunctionTracer._full_function_name(func)
+        if len(func_name) > 38:
+            func_name = "..." + func_name[-35:]
+        return func_name
+
+    @staticmethod
+    def _full_function_name(func: Callable) -> str:
+        """
+        Get the untruncated name of a traced function for exports.
+
+        Args:
+            func: Traced function
+
+        Returns:
+            Module-qualified name
+        """
+        if callable(func):
+            if hasattr(func, '__name__'):
+                if hasattr(func, '__module__') and func.__module__ != '__main__':
+                    func_name = f"{func.__module__}.{func.__name__}"
+                else:
+                    func_name = func.__name__
+            else:
+                func_name = str(func)
+        else:
+            func_name = str(func)
+        return func_name
@@ -0,0 +1,311 @@
+import sys
+import time
+import tracemalloc
+from dataclasses import field, fields, make_dataclass
+from tracer import FunctionTracer, FunctionStats, _tracer_speedups
+
+
+def make_functions(count):
+    """Create `count` distinct functions, each with its own code object."""
+    namespace = {}
+    for i in range(count):
+        exec(f"def generated_{i}():\n    return {i}\n", namespace)
+    return [namespace[f"generated_{i}"] for i in range(count)]
+
+
+def target_function():
+    """A tiny function whose call cost is dominated by tracing overhead."""
+    return 1
+
+
+def untraced_function():
+    """A tiny function that is never traced."""
+    return 2
+
+
+def loop_function():
+    """A traced function whose cost is a tight loop of many short lines."""
+    result = 0
+    for i in range(100):
+        result += i
+    return result
+
+
+class LineEventTracer(FunctionTracer):
+    """FunctionTracer that lets traced frames emit 'line' events again."""
+
+    def _trace_function(self, frame, event, arg):
+        local_trace = super()._trace_function(frame, event, arg)
+        if local_trace is not None:
+            frame.f_trace_lines = True
+        return local_trace
+
+
+def time_calls(iterations):
+    """Time `iterations` calls to the traced and the untraced function."""
+    start_time = time.perf_counter()
+    for _ in range(iterations):
+        target_function()
+        untraced_function()
+    return time.perf_counter() - start_time
+
+
+def bench_code_index_lookup(iterations=100000):
+    """Per-call tracing cost as the number of traced functions grows."""
+    print("\n=== Benchmark: Code Index Lookup ===")
+
+    baseline = time_calls(iterations)
+
+    print(f"{'Traced functions':<20} {'Per call (ns)':<15}")
+    for count in (5, 50, 500, 5000):
+        tracer = FunctionTracer()
+        tracer.enable(make_functions(count) + [target_function])
+        elapsed = time_calls(iterations)
+        tracer.disable()
+
+        per_call = (elapsed - baseline) / (iterations * 2) * 1e9
+        print(f"{count:<20} {per_call:<15.1f}")
+
+
+def available_engines():
+    """Names of the tracing engines usable on this interpreter."""
+    return [engine for engine in FunctionTracer.ENGINES
+            if engine != 'monitoring' or hasattr(sys, 'monitoring')]
+
+
+def time_untraced_calls(iterations):
+    """Time `iterations` calls to the untraced function only."""
+    start_time = time.perf_counter()
+    for _ in range(iterations):
+        untraced_function()
+    return time.perf_counter() - start_time
+
+
+def bench_engines(iterations=100000):
+    """Overhead each engine adds to traced and untraced calls."""
+    print("\n=== Benchmark: Tracing Engines ===")
+
+    baseline_untraced = time_untraced_calls(iterations)
+    baseline_mixed = time_calls(iterations)
+
+    print(f"{'Engine':<15} {'Untraced (ns)':<15} {'Traced (ns)':<15}")
+    for engine in available_engines():
+        tracer = FunctionTracer(engine=engine)
+        tracer.enable([target_function])
+        untraced = time_untraced_calls(iterations)
+        mixed = time_calls(iterations)
+        tracer.disable()
+
+        untraced_cost = (untraced - baseline_untraced) / iterations * 1e9
+        traced_cost = (mixed - baseline_mixed) / iterations * 1e9 - untraced_cost
+        print(f"{engine:<15} {untraced_cost:<15.1f} {traced_cost:<15.1f}")
+
+
+def bench_line_events(iterations=20000):
+    """Cost of a traced tight loop with and without per-line trace events."""
+    print("\n=== Benchmark: Line Events ===")
+
+    def time_loop():
+        start_time = time.perf_counter()
+        for _ in range(iterations):
+            loop_function()
+        return time.perf_counter() - start_time
+
+    baseline = time_loop()
+
+    print(f"{'Mode':<20} {'Per call (us)':<15} {'Overhead (us)':<15}")
+    print(f"{'untraced':<20} {baseline / iterations * 1e6:<15.2f} {0.0:<15.2f}")
+    for name, tracer in (("line events", LineEventTracer(engine='settrace')),
+                         ("no line events", FunctionTracer(engine='settrace'))):
+        tracer.enable([loop_function])
+        elapsed = time_loop()
+        tracer.disable()
+
+        per_call = elapsed / iterations * 1e6
+        overhead = (elapsed - baseline) / iterations * 1e6
+        print(f"{name:<20} {per_call:<15.2f} {overhead:<15.2f}")
+
+
+def bench_timed_decorator(iterations=100000):
+    """Overhead of the timed decorator compared to the tracing engines."""
+    print("\n=== Benchmark: Timed Decorator ===")
+
+    tracer = FunctionTracer()
+    timed_target = tracer._timed_wrapper(target_function)
+    perf_counter_ns = time.perf_counter_ns
+    total_ns = [0]
+
+    def two_clock_reads():
+        # The least any timing wrapper can cost
+        start_time = perf_counter_ns()
+        try:
+            return target_function()
+        finally:
+            total_ns[0] += perf_counter_ns() - start_time
+
+    def time_wrapper_calls(wrapper):
+        start_time = time.perf_counter()
+        for _ in range(iterations):
+            wrapper()
+        return time.perf_counter() - start_time
+
+    def time_target_calls():
+        start_time = time.perf_counter()
+        for _ in range(iterations):
+            target_function()
+        return time.perf_counter() - start_time
+
+    baseline = time_target_calls()
+
+    print(f"{'Mode':<20} {'Per call (ns)':<15}")
+    elapsed = time_wrapper_calls(two_clock_reads)
+    print(f"{'two clock reads':<20} {(elapsed - baseline) / iterations * 1e9:<15.1f}")
+
+    tracer.enable()
+    elapsed = time_wrapper_calls(timed_target)
+    tracer.disable()
+    print(f"{'timed decorator':<20} {(elapsed - baseline) / iterations * 1e9:<15.1f}")
+
+    for engine in available_engines():
+        tracer = FunctionTracer(engine=engine)
+        tracer.enable([target_function])
+        elapsed = time_target_calls()
+        tracer.disable()
+        print(f"{engine:<20} {(elapsed - baseline) / iterations * 1e9:<15.1f}")
+
+
+def bench_clock_paths(iterations=1000000):
+    """Per-event cost and accumulated error of float vs integer timing."""
+    print("\n=== Benchmark: Clock Paths ===")
+
+    perf_counter = time.perf_counter
+    perf_counter_ns = time.perf_counter_ns
+
+    def float_path():
+        total = 0.0
+        for _ in range(iterations):
+            start_time = perf_counter()
+            total += perf_counter() - start_time
+        return total
+
+    def int_path():
+        total = 0
+        for _ in range(iterations):
+            start_time = perf_counter_ns()
+            total += perf_counter_ns() - start_time
+        return total
+
+    print(f"{'Path':<20} {'Per event (ns)':<15}")
+    for name, path in (("float seconds", float_path), ("int nanoseconds", int_path)):
+        start_time = perf_counter()
+        path()
+        elapsed = perf_counter() - start_time
+        print(f"{name:<20} {elapsed / iterations * 1e9:<15.1f}")
+
+    # Summing many sub-microsecond durations as floats drifts from the exact total
+    duration_ns = 137
+    float_total = 0.0
+    for _ in range(iterations):
+        float_total += duration_ns / 1e9
+    exact_ns = duration_ns * iterations
+    error_ns = abs(float_total * 1e9 - exact_ns)
+    print(f"Float accumulation error over {iterations} x {duration_ns}ns: {error_ns:.3f}ns")
+    print("Integer accumulation error: 0.000ns")
+
+
+# FunctionStats with the same fields but an instance __dict__, for comparison
+DictFunctionStats = make_dataclass(
+    'DictFunctionStats',
+    [(f.name, f.type, field(default=f.default, default_factory=f.default_factory))
+     for f in fields(FunctionStats)])
+
+
+def bench_stats_memory(count=10000):
+    """Memory used by per-function stats records when tracing many functions."""
+    print("\n=== Benchmark: Stats Memory ===")
+
+    fields = dict(call_count=1, total_ns=1000, min_ns=1000, max_ns=1000)
+
+    def timed_record():
+        # What a traced function's shard entry holds after one timed call
+        stats = FunctionStats(**fields)
+        stats.histogram.record(1000)
+        return stats
+
+    print(f"{'Record':<20} {'Bytes per function':<20}")
+    for name, record in (("__dict__", lambda: DictFunctionStats(**fields)),
+                         ("__slots__", lambda: FunctionStats(**fields)),
+                         ("timed", timed_record)):
+        tracemalloc.start()
+        records = [record() for _ in range(count)]
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del records
+        print(f"{name:<20} {size / count:<20.1f}")
+
+
+def bench_sampling(iterations=100000):
+    """Per-call tracing cost of a tiny function at different sampling rates."""
+    print("\n=== Benchmark: Sampling ===")
+
+    def time_target_calls():
+        start_time = time.perf_counter()
+        for _ in range(iterations):
+            target_function()
+        return time.perf_counter() - start_time
+
+    baseline = time_target_calls()
+
+    print(f"{'Engine':<15} {'1-in-N':<10} {'Per call (ns)':<15}")
+    for engine in available_engines():
+        for sample_rate in (1, 16, 256):
+            tracer = FunctionTracer(engine=engine)
+            tracer.enable([target_function], sample_rate=sample_rate)
+            elapsed = time_target_calls()
+            tracer.disable()
+            per_call = (elapsed - baseline) / iterations * 1e9
+            print(f"{engine:<15} {sample_rate:<10} {per_call:<15.1f}")
+
+
+def bench_native_hook(iterations=100000):
+    """Profile engine overhead with the pure-Python and the compiled hook."""
+    print("\n=== Benchmark: Native Profile Hook ===")
+
+    if _tracer_speedups is None:
+        print("_tracer_speedups is not built, run: python setup.py build_ext --inplace")
+        return
+
+    baseline_untraced = time_untraced_calls(iterations)
+    baseline_mixed = time_calls(iterations)
+
+    print(f"{'Hook':<15} {'Untraced (ns)':<15} {'Traced (ns)':<15}")
+    for name, accelerate in (("pure-Python", False), ("native", True)):
+        tracer = FunctionTracer(engine='profile', accelerate=accelerate)
+        tracer.enable([target_function])
+        untraced = time_untraced_calls(iterations)
+        mixed = time_calls(iterations)
+        tracer.disable()
+
+        untraced_cost = (untraced - baseline_untraced) / iterations * 1e9
+        traced_cost = (mixed - baseline_mixed) / iterations * 1e9 - untraced_cost
+        print(f"{name:<15} {untraced_cost:<15.1f} {traced_cost:<15.1f}")
+
+
+def main():
+    """Run all benchmarks."""
+    print("=== Function Tracer Benchmarks ===")
+
+    bench_code_index_lookup()
+    bench_engines()
+    bench_line_events()
+    bench_timed_decorator()
+    bench_clock_paths()
+    bench_stats_memory()
+    bench_sampling()
+    bench_native_hook()
+
+    print("\n=== All benchmarks completed ===")
+
+
+if __name__ == "__main__":
+    main()
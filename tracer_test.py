@@ -1,6 +1,21 @@
+import io
+import os
+import sys
+import json
+import mmap
 import time
+import tempfile
 import random
-from tracer import FunctionTracer
+import queue
+import asyncio
+import threading
+from tracer import FunctionTracer, DDSketch, EventLog, EventLogReader, _tracer_speedups
+
+
+def available_engines():
+    """Names of the tracing engines usable on this interpreter."""
+    return [engine for engine in FunctionTracer.ENGINES
+            if engine != 'monitoring' or hasattr(sys, 'monitoring')]
 
 
 def slow_function(sleep_time=0.1):
@@ -27,6 +42,21 @@ def decorated_function(iterations=1000):
     return result
 
 
+@FunctionTracer.trace(timed=True)
+def timed_function(iterations=1000):
+    """A function that times itself through the decorator."""
+    result = 0
+    for i in range(iterations):
+        result += i
+    return result
+
+
+@FunctionTracer.trace(timed=True)
+def timed_caller():
+    """A self-timing function calling another one."""
+    return timed_function() + timed_function(10)
+
+
 def varying_duration():
     """Function with variable execution times."""
     sleep_time = random.uniform(0.01, 0.05)
@@ -34,6 +64,98 @@ def varying_duration():
     return sleep_time
 
 
+def outer_function():
+    """A function whose time is mostly spent in the functions it calls."""
+    for _ in range(3):
+        fast_function()
+    return slow_function(0.01)
+
+
+def counting_generator(count=3):
+    """A generator that does a little work for each value it yields."""
+    for i in range(count):
+        fast_function()
+        yield i
+
+
+def retrying_generator():
+    """A generator that recovers from the errors thrown into it."""
+    attempt = 0
+    while True:
+        try:
+            yield attempt
+        except ValueError:
+            attempt += 1
+
+
+async def sleeping_coroutine():
+    """A coroutine that spends most of its lifetime suspended."""
+    fast_function()
+    await asyncio.sleep(0.02)
+    fast_function()
+    return "done"
+
+
+async def waiting_coroutine(event):
+    """A coroutine that waits for an event, then does a little work."""
+    await event.wait()
+    fast_function()
+
+
+async def blocking_coroutine(event):
+    """A coroutine that blocks the event loop once the event is set."""
+    await event.wait()
+    time.sleep(0.02)
+
+
+def flaky_function(attempt):
+    """A function whose failures take longer than its successes."""
+    if attempt % 4 == 0:
+        time.sleep(0.005)
+        raise TimeoutError("gave up")
+    if attempt % 4 == 1:
+        raise KeyError(attempt)
+    try:
+        raise ValueError(attempt)
+    except ValueError:
+        pass  # Handled, the call still returns normally
+    return None
+
+
+def cleanup_generator(count=3):
+    """A generator that cleans up however its consumer stops."""
+    try:
+        for i in range(count):
+            yield i
+    finally:
+        fast_function()
+
+
+def recursive_function(depth):
+    """A recursive function doing fast_function's work at every level."""
+    result = fast_function()
+    if depth > 0:
+        result += recursive_function(depth - 1)
+    return result
+
+
+def unhooking_function(engine):
+    """A function removing the tracer's hook, so that its return goes unseen."""
+    if engine == 'profile':
+        sys.setprofile(None)
+    else:
+        sys.settrace(None)
+
+
+def hook_swapping_function(engine, hook):
+    """A function calling unhooking_function, then reinstalling the hook."""
+    unhooking_function(engine)
+    if engine == 'profile':
+        sys.setprofile(hook)
+    else:
+        sys.settrace(hook)
+
+
 def test_basic_tracing():
     """Test basic function tracing."""
     print("\n=== Test 1: Basic Function Tracing ===")
@@ -137,6 +259,912 @@ def test_dynamic_toggling():
     tracer.disable()
 
 
+def test_engines():
+    """Test that every available engine produces the same call counts."""
+    print("\n=== Test 6: Tracing Engines ===")
+
+    for engine in available_engines():
+        tracer = FunctionTracer(engine=engine)
+        tracer.enable([fast_function])
+
+        print(f"Calling fast_function with the {engine} engine...")
+        for _ in range(3):
+            fast_function()
+        slow_function(0.01)
+
+        results = tracer.disable()
+        print(tracer.format_results())
+
+        assert tracer.engine == engine
+        assert results[fast_function].call_count == 3
+        assert slow_function not in results
+
+
+def test_profile_engine_builtins():
+    """Test timing built-in functions with the profile engine."""
+    print("\n=== Test 7: Profile Engine Built-ins ===")
+
+    original_sleep = time.sleep
+    tracer = FunctionTracer(engine='profile')
+
+    tracer.enable([slow_function, time.sleep])
+
+    print("Calling slow_function and time.sleep...")
+    slow_function(0.02)
+    time.sleep(0.01)
+
+    # Built-ins are timed from c_call/c_return events, not by wrapping them
+    assert time.sleep is original_sleep
+
+    results = tracer.disable()
+    print("\nResults after profile engine tracing:")
+    print(tracer.format_results())
+
+    assert results[slow_function].call_count == 1
+    assert results[time.sleep].call_count == 2
+    assert results[time.sleep].min_time >= 0.01
+
+
+def test_timed_decorator():
+    """Test the decorator timing calls without an interpreter hook."""
+    print("\n=== Test 8: Timed Decorator ===")
+
+    tracer = FunctionTracer.get_instance()
+
+    print("Calling timed_function while tracing is disabled...")
+    timed_function()
+
+    tracer.enable()
+
+    print("Calling timed_function...")
+    timed_function()
+    timed_function(10)
+    print("Calling timed_caller...")
+    timed_caller()
+
+    results = tracer.disable()
+    call_graph = tracer.get_call_graph()
+    print("\nResults after timed decorator tracing:")
+    print(tracer.format_results())
+
+    stats = results[timed_function.__wrapped__]
+    assert stats.call_count == 4
+    assert stats.min_time <= stats.max_time
+    # Timed callees are taken out of the self time of the outermost call
+    caller = results[timed_caller.__wrapped__]
+    edge = call_graph[(timed_caller.__wrapped__, timed_function.__wrapped__)]
+    assert edge.call_count == 2
+    assert abs(caller.total_time - caller.self_time - edge.total_time) < 1e-6
+
+
+def test_multithreaded_tracing():
+    """Test that calls made in worker threads are traced by every engine."""
+    print("\n=== Test 9: Multi-threaded Tracing ===")
+
+    for engine in available_engines():
+        tracer = FunctionTracer(engine=engine)
+        tracer.enable([fast_function])
+
+        def worker():
+            for _ in range(5):
+                fast_function()
+
+        print(f"Calling fast_function from 4 threads with the {engine} engine...")
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        fast_function()
+        for thread in threads:
+            thread.join()
+
+        results = tracer.disable()
+        print(tracer.format_results())
+
+        assert results[fast_function].call_count == 21
+
+        def other_hook(frame, event, arg):
+            # Stands for a debugger or coverage tool installed before tracing
+            return None
+
+        sys.settrace(other_hook)
+        sys.setprofile(other_hook)
+        threading.settrace(other_hook)
+        threading.setprofile(other_hook)
+        tracer = FunctionTracer(engine=engine)
+        tracer.enable([fast_function])
+
+        requests = queue.Queue()
+        hooks = []
+
+        def live_worker():
+            while requests.get():
+                fast_function()
+                hooks.append((sys.gettrace(), sys.getprofile()))
+
+        print(f"Calling into a live worker thread after disable() with the {engine} engine...")
+        thread = threading.Thread(target=live_worker)
+        thread.start()
+        requests.put(True)
+        while not hooks:
+            time.sleep(0.001)
+        results = tracer.disable()
+        assert results[fast_function].call_count == 1
+
+        for _ in range(100):
+            requests.put(True)
+        requests.put(False)
+        thread.join()
+
+        sys.settrace(None)
+        sys.setprofile(None)
+        threading.settrace(None)
+        threading.setprofile(None)
+
+        # The worker put back the hooks it had been given before tracing,
+        # and recorded nothing more
+        assert hooks[-1] == (other_hook, other_hook)
+        assert tracer.get_results()[fast_function].call_count == 1
+
+    tracer = FunctionTracer()
+    threads = [threading.Thread(target=time.sleep, args=(0.5,)) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    print("Cycling enable()/disable() 200 times...")
+    for _ in range(200):
+        tracer.enable([fast_function])
+        fast_function()
+        tracer.disable()
+    for thread in threads:
+        thread.join()
+
+    # Disabling folds the shards of every thread instead of keeping them
+    assert len(tracer._shards) <= 1
+    assert tracer.get_results()[fast_function].call_count == 200
+
+
+def test_thread_stats_shards():
+    """Test merging stats shards of threads that have already exited."""
+    print("\n=== Test 10: Thread Stats Shards ===")
+
+    # A tracer of its own, so that the singleton's timed_function stats from
+    # test 8 are not mixed in, whichever test runs first
+    tracer = FunctionTracer()
+    timed = tracer._timed_wrapper(timed_function.__wrapped__)
+    tracer.enable([fast_function])
+
+    def worker():
+        fast_function()
+        timed(10)
+
+    print("Running 8 short-lived worker threads...")
+    for _ in range(8):
+        thread = threading.Thread(target=worker)
+        thread.start()
+        thread.join()
+
+    first = tracer.get_results()
+    second = tracer.get_results()
+    tracer.disable()
+
+    print("\nResults after thread stats shards:")
+    print(tracer.format_results())
+
+    # Reading twice must not double count shards folded in by the first read
+    assert first[fast_function].call_count == second[fast_function].call_count == 8
+    assert first[timed_function.__wrapped__].call_count == second[timed_function.__wrapped__].call_count == 8
+
+
+def test_latency_percentiles():
+    """Test percentile estimates from the per-function latency histogram."""
+    print("\n=== Test 11: Latency Percentiles ===")
+
+    tracer = FunctionTracer()
+    tracer.enable([varying_duration])
+
+    print("Calling varying_duration 10 times...")
+    durations = sorted(varying_duration() for _ in range(10))
+
+    results = tracer.disable()
+    print("\nResults after latency percentile tracing:")
+    print(tracer.format_results())
+
+    stats = results[varying_duration]
+    p50 = stats.percentile(50)
+    p99 = stats.percentile(99)
+    assert stats.min_time <= p50 <= p99 <= stats.max_time
+    # Histogram buckets are at most 1/16 wide and each call outlasts its sleep
+    assert p99 >= durations[-1] * 0.9
+
+    tracer = FunctionTracer()
+    tracer.enable([fast_function], sample_rate=100)
+    for _ in range(10):
+        fast_function()
+    results = tracer.disable()
+
+    # Functions that were never timed hold no histogram buckets
+    assert results[fast_function].call_count == 10
+    assert results[fast_function].histogram.counts is None
+    assert results[fast_function].percentile(50) == 0.0
+
+
+def test_quantile_sketch():
+    """Test attaching mergeable quantile sketches to the function stats."""
+    print("\n=== Test 12: Quantile Sketch ===")
+
+    tracer = FunctionTracer(sketch_factory=lambda: DDSketch(relative_accuracy=0.01))
+    tracer.enable([slow_function])
+
+    print("Calling slow_function from 2 threads...")
+    threads = [threading.Thread(target=slow_function, args=(0.02,)) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    slow_function(0.04)
+    for thread in threads:
+        thread.join()
+
+    results = tracer.disable()
+    print("\nResults after quantile sketch tracing:")
+    print(tracer.format_results())
+
+    stats = results[slow_function]
+    assert stats.sketch.count == 3
+    # Percentiles come from the sketch, within 1% of a recorded duration
+    assert 0.02 <= stats.percentile(50) <= stats.max_time * 1.01
+    assert abs(stats.percentile(100) - stats.max_time) <= stats.max_time * 0.01
+
+    # Sketches from another process can be merged after a round trip
+    restored = DDSketch.from_dict(stats.sketch.to_dict())
+    restored.merge(stats.sketch)
+    assert restored.count == 6
+
+    tracer = FunctionTracer(engine='profile',
+                            sketch_factory=lambda: DDSketch(relative_accuracy=0.01))
+    summing_function = timed_function.__wrapped__
+    tracer.enable([summing_function, flaky_function])
+    stop = threading.Event()
+
+    def worker(seed):
+        rng = random.Random(seed)
+        attempt = 0
+        while not stop.is_set():
+            # New durations keep adding sketch bins, new failures exception stats
+            summing_function(rng.randrange(1, 5000))
+            attempt += 1
+            if attempt % 50 == 0:
+                try:
+                    flaky_function(attempt // 50 % 3 + 1)
+                except KeyError:
+                    pass
+
+    print("Reading the results while 3 threads are being traced...")
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)  # Switch threads inside the merge loops
+    threads = [threading.Thread(target=worker, args=(seed,)) for seed in range(3)]
+    try:
+        for thread in threads:
+            thread.start()
+        for _ in range(200):
+            results = tracer.get_results()
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+        sys.setswitchinterval(switch_interval)
+    results = tracer.disable()
+
+    # Reads merged live shards while their sketches and exception dicts grew
+    stats = results[summing_function]
+    assert stats.sketch.count == stats.timed_count > 0
+
+
+def tiny_function():
+    """A function so short that timing every call would dominate its cost."""
+    return 1
+
+
+def test_sampling():
+    """Test timing 1-in-N calls while still counting every call."""
+    print("\n=== Test 13: Sampling ===")
+
+    for engine in available_engines():
+        tracer = FunctionTracer(engine=engine)
+        tracer.enable([fast_function, time.sleep], sample_rate=4)
+
+        print(f"Calling fast_function 20 times with the {engine} engine...")
+        for _ in range(20):
+            fast_function()
+        for _ in range(4):
+            time.sleep(0.001)
+
+        results = tracer.disable()
+        print(tracer.format_results())
+
+        stats = results[fast_function]
+        assert stats.call_count == 20
+        assert stats.timed_count == 5
+        # Totals are scaled from the timed calls to all calls
+        assert abs(stats.total_time - stats.avg_time * 20) < 1e-9
+        assert results[time.sleep].call_count == 4
+        assert results[time.sleep].timed_count == 1
+
+
+def test_overhead_governor():
+    """Test demoting functions whose tracing cost exceeds the budget."""
+    print("\n=== Test 14: Overhead Governor ===")
+
+    tracer = FunctionTracer()
+    tracer.enable([tiny_function, slow_function], overhead_budget=0.05)
+
+    print("Calling tiny_function 5000 times and slow_function twice...")
+    for _ in range(5000):
+        tiny_function()
+    slow_function(0.01)
+    slow_function(0.01)
+
+    results = tracer.disable()
+    print("\nResults after overhead governor tracing:")
+    print(tracer.format_results())
+
+    stats = results[tiny_function]
+    assert stats.call_count == 5000
+    assert stats.mode == 'counted'
+    assert stats.timed_count == 16
+    assert results[slow_function].mode == 'timed'
+    assert list(tracer.get_demoted_functions()) == [tiny_function]
+
+    print("Re-enabling without a budget and calling tiny_function 100 times...")
+    tracer.enable([tiny_function, slow_function], sample_rate=2)
+    for _ in range(100):
+        tiny_function()
+    assert tracer.get_demoted_functions() == {}
+    results = tracer.disable()
+    assert results[tiny_function].call_count == 5100
+    assert results[tiny_function].mode == 'sampled'
+    assert results[slow_function].sample_rate == 2
+    assert tracer.get_demoted_functions() == {}
+
+
+def test_overhead_calibration():
+    """Test subtracting the calibrated tracer overhead from durations."""
+    print("\n=== Test 15: Overhead Calibration ===")
+
+    averages = {}
+    for calibrate in (False, True):
+        tracer = FunctionTracer(calibrate=calibrate)
+        tracer.enable([tiny_function])
+
+        print(f"Calling tiny_function 1000 times with calibrate={calibrate}...")
+        for _ in range(1000):
+            tiny_function()
+
+        results = tracer.disable()
+        print(tracer.format_results())
+
+        averages[calibrate] = results[tiny_function].avg_time
+        if calibrate:
+            assert tracer.calibration.engine == tracer.engine
+        else:
+            assert tracer.calibration is None
+
+    # The tracer's own cost dwarfs an empty function until it is subtracted
+    assert averages[True] < averages[False]
+
+
+def test_self_time():
+    """Test attributing the time of traced callees to exclusive time."""
+    print("\n=== Test 16: Self Time ===")
+
+    for engine in available_engines():
+        tracer = FunctionTracer(engine=engine)
+        tracer.enable([outer_function, fast_function, slow_function, time.sleep])
+
+        print(f"Calling outer_function with the {engine} engine...")
+        outer_function()
+
+        results = tracer.disable()
+        report = tracer.format_results()
+        print(report)
+
+        # The separators span the widened header
+        _, separator, header, closing = report.splitlines()[:4]
+        assert separator == closing == "-" * len(header)
+
+        outer = results[outer_function]
+        slow = results[slow_function]
+        sleep = results[time.sleep]
+        # Nearly all of slow_function is spent sleeping
+        assert slow.self_time < slow.total_time * 0.5
+        assert abs(sleep.self_time - sleep.total_time) < 1e-9
+        # Self time is inclusive time minus the inclusive time of traced callees
+        callees = results[fast_function].total_time + slow.total_time
+        assert abs(outer.total_time - outer.self_time - callees) < 1e-6
+
+
+def test_call_graph():
+    """Test aggregating caller -> callee edges between traced functions."""
+    print("\n=== Test 17: Call Graph ===")
+
+    for engine in available_engines():
+        tracer = FunctionTracer(engine=engine)
+        tracer.enable([outer_function, fast_function, slow_function, time.sleep])
+
+        print(f"Calling outer_function twice with the {engine} engine...")
+        outer_function()
+        outer_function()
+        fast_function()
+
+        results = tracer.disable()
+        call_graph = tracer.get_call_graph()
+        print(tracer.format_call_graph())
+
+        assert set(call_graph) == {
+            (outer_function, fast_function),
+            (outer_function, slow_function),
+            (slow_function, time.sleep),
+        }
+        assert call_graph[(outer_function, fast_function)].call_count == 6
+        assert call_graph[(slow_function, time.sleep)].call_count == 2
+        # The edges out of a function account for all of its callee time
+        outer = results[outer_function]
+        callees = sum(edge.total_time for (caller, _), edge in call_graph.items()
+                      if caller is outer_function)
+        assert abs(outer.total_time - outer.self_time - callees) < 1e-6
+
+
+def test_call_paths():
+    """Test aggregating whole call paths in a prefix tree."""
+    print("\n=== Test 18: Call Paths ===")
+
+    for engine in available_engines():
+        tracer = FunctionTracer(engine=engine)
+        tracer.enable([outer_function, fast_function, slow_function, time.sleep])
+
+        print(f"Calling outer_function twice and slow_function with the {engine} engine...")
+        outer_function()
+        outer_function()
+        slow_function(0.01)
+
+        results = tracer.disable()
+        paths = {path: node for path, node in tracer.iter_call_paths()}
+        for path, node in paths.items():
+            names = " -> ".join(tracer._function_name(func) for func in path)
+            print(f"{names}: {node.call_count} calls, {node.self_time:.6f}s self")
+
+        # The same stack repeated shares one node, different stacks do not
+        assert paths[(outer_function, fast_function)].call_count == 6
+        assert paths[(outer_function, slow_function, time.sleep)].call_count == 2
+        assert paths[(slow_function, time.sleep)].call_count == 1
+        assert len(paths) == 6
+        # Self times over all paths add up to the inclusive time of the roots
+        root = tracer.get_call_paths()
+        roots_total = sum(child.total_ns for child in root.children.values())
+        assert abs(sum(node.self_ns for node in paths.values()) - roots_total) < 1000
+        assert paths[(outer_function,)].call_count == results[outer_function].call_count
+
+    for engine in available_engines():
+        tracer = FunctionTracer(engine=engine)
+        tracer.enable([outer_function, fast_function, slow_function], sample_rate=2)
+
+        print(f"Calling outer_function 4 times, timing 1 in 2 calls with the {engine} engine...")
+        for _ in range(4):
+            outer_function()
+
+        tracer.disable()
+        paths = {path: node for path, node in tracer.iter_call_paths()}
+        call_graph = tracer.get_call_graph()
+
+        # Callees of untimed calls still sit below their caller, not at the root
+        assert [path for path in paths if len(path) == 1] == [(outer_function,)]
+        assert paths[(outer_function,)].call_count == 2
+        assert paths[(outer_function, fast_function)].call_count == 6
+        assert paths[(outer_function, slow_function)].call_count == 2
+        assert call_graph[(outer_function, fast_function)].call_count == 6
+        assert call_graph[(outer_function, slow_function)].call_count == 2
+        assert len(call_graph) == 2
+
+
+def test_flame_graph_export():
+    """Test exporting call paths as folded stacks and speedscope JSON."""
+    print("\n=== Test 19: Flame Graph Export ===")
+
+    tracer = FunctionTracer()
+    tracer.enable([outer_function, fast_function, slow_function, time.sleep])
+
+    print("Calling outer_function...")
+    outer_function()
+
+    tracer.disable()
+
+    folded = io.StringIO()
+    tracer.export_folded_stacks(folded)
+    print("\nFolded stacks:")
+    print(folded.getvalue())
+
+    lines = folded.getvalue().splitlines()
+    stacks = {}
+    for line in lines:
+        stack, self_ns = line.rsplit(" ", 1)
+        # Drop module names, which depend on how the tests are run
+        stacks[";".join(name.rsplit(".", 1)[-1] for name in stack.split(";"))] = int(self_ns)
+    assert set(stacks) == {"outer_function", "outer_function;fast_function",
+                           "outer_function;slow_function", "outer_function;slow_function;sleep"}
+    assert stacks["outer_function;slow_function;sleep"] >= 10_000_000
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "profile.speedscope.json")
+        tracer.export_speedscope(path)
+        with open(path, encoding='utf-8') as file:
+            profile = json.load(file)
+
+    frames = profile['shared']['frames']
+    samples = profile['profiles'][0]['samples']
+    weights = profile['profiles'][0]['weights']
+    print(f"Speedscope profile: {len(frames)} frames, {len(samples)} samples")
+    assert len(samples) == len(weights) == len(lines)
+    assert profile['profiles'][0]['endValue'] == sum(stacks.values())
+    assert [frames[index]['name'].rsplit(".", 1)[-1] for index in samples[0]] == ["outer_function"]
+    assert frames[samples[0][0]]['line'] == outer_function.__code__.co_firstlineno
+
+
+def test_chrome_trace_export():
+    """Test recording a bounded timeline and exporting it as Chrome trace events."""
+    print("\n=== Test 20: Chrome Trace Export ===")
+
+    tracer = FunctionTracer(timeline_capacity=8)
+    tracer.enable([fast_function, time.sleep])
+
+    print("Calling fast_function 20 times and time.sleep from a thread...")
+    for _ in range(20):
+        fast_function()
+    thread = threading.Thread(target=time.sleep, args=(0.01,))
+    thread.start()
+    thread.join()
+
+    tracer.disable()
+
+    timeline = tracer.timeline
+    print(f"Timeline keeps {len(timeline)} calls, dropped {timeline.dropped}")
+    assert len(timeline) == 8
+    assert timeline.dropped == 13
+
+    output = io.StringIO()
+    tracer.export_chrome_trace(output)
+    events = [event for event in json.loads(output.getvalue())['traceEvents']
+              if event['ph'] == 'X']
+    for event in events:
+        print(f"{event['name']}: ts={event['ts']:.3f}us dur={event['dur']:.3f}us tid={event['tid']}")
+
+    # The oldest calls were dropped, the 7 most recent fast_function calls remain
+    assert [event['name'].rsplit(".", 1)[-1] for event in events] == ["fast_function"] * 7 + ["sleep"]
+    assert all(a['ts'] < b['ts'] for a, b in zip(events, events[1:]))
+    assert events[-1]['tid'] == thread.ident != events[0]['tid']
+    assert events[-1]['dur'] >= 10000
+
+
+def test_event_log():
+    """Test appending calls to a memory-mapped binary log and reading it back."""
+    print("\n=== Test 21: Binary Event Log ===")
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "calls.ftlog")
+        # The smallest chunk holds 128 records, so 300 calls grow the file twice
+        with EventLog(path, chunk_size=mmap.ALLOCATIONGRANULARITY) as log:
+            tracer = FunctionTracer(event_log=log)
+            tracer.enable([tiny_function, fast_function])
+
+            print("Calling tiny_function 300 times and fast_function twice...")
+            for _ in range(300):
+                tiny_function()
+            fast_function()
+            fast_function()
+
+            results = tracer.disable()
+
+        print(f"Log file size: {os.path.getsize(path)} bytes")
+        with EventLogReader(path) as reader:
+            records = list(reader)
+            names = [name.rsplit(".", 1)[-1] for name in reader.functions]
+            print(f"Read {len(reader)} records of {names}")
+
+            assert len(reader) == 302
+            assert len(reader.view) == 302 * 4
+            assert reader.view[4 * 301 + 2] == records[-1][2]
+
+        counts = {}
+        for function_id, thread_id, start_ns, duration_ns in records:
+            counts[names[function_id]] = counts.get(names[function_id], 0) + 1
+            assert thread_id == threading.get_ident()
+        assert counts == {"tiny_function": 300, "fast_function": 2}
+        fast_total = sum(record[3] for record in records if names[record[0]] == "fast_function")
+        assert fast_total == results[fast_function].total_ns
+
+
+def test_generator_and_coroutine_timing():
+    """Test timing generators and coroutines once per invocation."""
+    print("\n=== Test 22: Generator and Coroutine Timing ===")
+
+    for engine in available_engines():
+        tracer = FunctionTracer(engine=engine)
+        tracer.enable([counting_generator, sleeping_coroutine, fast_function])
+
+        print(f"Consuming generators and running a coroutine with the {engine} engine...")
+        for _ in counting_generator():
+            time.sleep(0.005)
+        # Abandoned while suspended, then closed
+        generator = counting_generator()
+        next(generator)
+        generator.close()
+        asyncio.run(sleeping_coroutine())
+
+        results = tracer.disable()
+        print(tracer.format_results())
+
+        # One call per invocation, not one per yield or await. Python 3.13+
+        # closes a generator suspended outside any try block without running
+        # it, and on 3.10 the close looks like one more suspension, so that
+        # invocation is counted but never timed.
+        generator_stats = results[counting_generator]
+        assert generator_stats.call_count == 2
+        assert generator_stats.timed_count == (2 if (3, 11) <= sys.version_info < (3, 13) else 1)
+        coroutine = results[sleeping_coroutine]
+        assert coroutine.call_count == 1
+        # Suspended time counts towards the lifetime, not the active time
+        assert generator_stats.wall_time >= 0.015
+        assert generator_stats.total_time < 0.01
+        assert coroutine.wall_time >= 0.02
+        assert coroutine.total_time < 0.01
+        assert results[fast_function].call_count == 6
+
+    for engine in available_engines():
+        tracer = FunctionTracer(engine=engine)
+        tracer.enable([retrying_generator])
+
+        print(f"Throwing into a generator that keeps going with the {engine} engine...")
+        generator = retrying_generator()
+        next(generator)
+        assert generator.throw(ValueError) == 1
+        assert generator.throw(ValueError) == 2
+
+        # Yielding again at the yield the error was thrown in is no return
+        stats = tracer.get_results()[retrying_generator]
+        assert stats.call_count == 1
+        assert stats.timed_count == 0
+        generator.close()
+        assert tracer.disable()[retrying_generator].call_count == 1
+
+
+def test_asyncio_tasks():
+    """Test splitting asyncio task lifetimes into running, awaiting and queued time."""
+    print("\n=== Test 23: asyncio Task Latency ===")
+
+    async def run_tasks(tracer):
+        tracer.instrument_asyncio()
+        event = asyncio.Event()
+        # Untraced, and woken first: it keeps the loop busy while the
+        # traced tasks are ready to run
+        blocker = asyncio.create_task(blocking_coroutine(event))
+        tasks = [asyncio.create_task(waiting_coroutine(event)) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        event.set()
+        await asyncio.gather(blocker, *tasks)
+
+    for engine in available_engines():
+        tracer = FunctionTracer(engine=engine)
+        tracer.enable([waiting_coroutine, fast_function])
+
+        print(f"Running tasks behind a blocking one with the {engine} engine...")
+        asyncio.run(run_tasks(tracer))
+
+        results = tracer.disable()
+        print(tracer.format_results())
+
+        stats = results[waiting_coroutine]
+        assert stats.task_count == 3
+        assert blocking_coroutine not in results
+        # Each task waited ~10ms for the event, then ~20ms behind the blocker
+        assert stats.task_awaited_ns / stats.task_count >= 5e6
+        assert stats.task_queued_ns / stats.task_count >= 15e6
+        assert stats.task_running_ns / stats.task_count < 10e6
+        assert results[fast_function].call_count == 3
+
+
+def test_exception_timing():
+    """Test separating calls that raised from calls that returned."""
+    print("\n=== Test 24: Exception Path Timing ===")
+
+    for engine in available_engines():
+        tracer = FunctionTracer(engine=engine)
+        tracer.enable([flaky_function, cleanup_generator])
+
+        print(f"Calling a function that sometimes raises with the {engine} engine...")
+        for attempt in range(20):
+            try:
+                flaky_function(attempt)
+            except (TimeoutError, KeyError):
+                pass
+        print("Leaving a loop over a generator early and closing another one...")
+        for _ in cleanup_generator():
+            break
+        generator = cleanup_generator()
+        next(generator)
+        generator.close()
+
+        results = tracer.disable()
+        print(tracer.format_results())
+
+        stats = results[flaky_function]
+        assert stats.timed_count == 20
+        assert stats.exception_count == 10
+        assert stats.success_count == 10
+        if engine == 'profile':
+            # setprofile() is not told what was raised
+            assert set(stats.exceptions) == {BaseException}
+        else:
+            assert set(stats.exceptions) == {TimeoutError, KeyError}
+            assert stats.exceptions[TimeoutError].timed_count == 5
+            assert stats.exceptions[TimeoutError].min_time >= 0.004
+        successes = stats.successes()
+        assert successes.timed_count == 10
+        assert successes.max_time < 0.004
+        assert successes.total_ns + sum(error_stats.total_ns for error_stats
+                                        in stats.exceptions.values()) == stats.total_ns
+
+        # Abandoning a generator is no failure, even when the engine can't
+        # see that it was GeneratorExit
+        cleanup = results[cleanup_generator]
+        assert cleanup.call_count == cleanup.timed_count == 2
+        assert not cleanup.exceptions
+
+    # Timed wrappers see the exception itself
+    tracer = FunctionTracer()
+    timed_flaky = tracer._timed_wrapper(flaky_function)
+    tracer.enable()
+    for attempt in range(8):
+        try:
+            timed_flaky(attempt)
+        except (TimeoutError, KeyError):
+            pass
+    results = tracer.disable()
+    stats = results[flaky_function]
+    assert stats.exceptions[TimeoutError].timed_count == 2
+    assert stats.exceptions[KeyError].timed_count == 2
+    assert stats.success_count == 4
+
+
+def test_recursion_and_stale_entries():
+    """Test deep recursion, calls exiting unseen and reused generator frames."""
+    print("\n=== Test 25: Recursion and Stale Stack Entries ===")
+
+    for engine in available_engines():
+        tracer = FunctionTracer(engine=engine)
+        tracer.enable([recursive_function, fast_function])
+
+        print(f"Recursing 200 levels deep with the {engine} engine...")
+        recursive_function(200)
+
+        assert tracer._local.stack == []
+        paths = list(tracer.iter_call_paths())
+        results = tracer.disable()
+
+        stats = results[recursive_function]
+        assert stats.call_count == 201
+        assert results[fast_function].call_count == 201
+        # The outermost level contains every level below it
+        assert stats.max_ns >= results[fast_function].total_ns * 0.8
+        assert stats.self_ns < results[fast_function].total_ns
+        assert max(len(path) for path, _ in paths) == 202
+
+    for engine in available_engines():
+        tracer = FunctionTracer(engine=engine)
+        tracer.enable([recursive_function, fast_function], sample_rate=64)
+
+        print(f"Recursing 200 levels deep, mostly not sampled, with the {engine} engine...")
+        recursive_function(200)
+
+        state = tracer._local
+        results = tracer.disable()
+
+        # Calls that were not sampled still return to their own entry
+        assert state.stale_entries == 0
+        assert state.stack == []
+        assert results[recursive_function].call_count == 201
+        assert results[recursive_function].timed_count == 3
+
+    for engine in ('settrace', 'profile'):
+        tracer = FunctionTracer(engine=engine)
+        tracer.enable([hook_swapping_function, unhooking_function, fast_function])
+
+        print(f"Missing a return event with the {engine} engine...")
+        hook = sys.getprofile() if engine == 'profile' else sys.gettrace()
+        hook_swapping_function(engine, hook)
+        fast_function()
+
+        state = tracer._local
+        results = tracer.disable()
+
+        # unhooking_function never returned as far as the tracer knows
+        assert state.stale_entries == 1
+        assert state.stack == []
+        assert results[unhooking_function].call_count == 1
+        assert results[unhooking_function].timed_count == 0
+        assert results[hook_swapping_function].timed_count == 1
+        # Later calls are not attributed to the stale entry
+        graph = tracer.get_call_graph()
+        assert (unhooking_function, fast_function) not in graph
+        assert [path for path, _ in tracer.iter_call_paths() if path[-1] is fast_function] == [(fast_function,)]
+
+    for engine in available_engines():
+        tracer = FunctionTracer(engine=engine)
+        tracer.enable([counting_generator, fast_function])
+
+        print(f"Abandoning generators whose frames get reused with the {engine} engine...")
+        for _ in range(50):
+            generator = counting_generator()
+            next(generator)
+            del generator
+        for _ in counting_generator():
+            pass
+
+        results = tracer.disable()
+
+        stats = results[counting_generator]
+        assert stats.call_count == 51
+        assert stats.max_time < 0.05
+        assert results[fast_function].call_count == 53
+
+
+def test_native_profile_hook():
+    """Test the compiled profile hook against the pure-Python one."""
+    print("\n=== Test 26: Native Profile Hook ===")
+
+    if _tracer_speedups is None:
+        print("_tracer_speedups is not built, skipping (python setup.py build_ext --inplace)")
+        return
+
+    results_by_mode = {}
+    for accelerate in (False, True):
+        tracer = FunctionTracer(engine='profile', accelerate=accelerate)
+        tracer.enable([outer_function, fast_function, flaky_function, time.sleep])
+
+        mode = "native" if accelerate else "pure-Python"
+        print(f"Tracing with the {mode} profile hook...")
+        assert isinstance(sys.getprofile(), _tracer_speedups.ProfileHook) == accelerate
+        outer_function()
+        for attempt in range(8):
+            try:
+                flaky_function(attempt)
+            except (TimeoutError, KeyError):
+                pass
+        # Started after enable(), the thread installs the hook on its first event
+        thread = threading.Thread(target=fast_function)
+        thread.start()
+        thread.join()
+        # The hook follows the rebuilt code index
+        tracer.update_functions([outer_function, fast_function, slow_function, time.sleep])
+        slow_function(0.01)
+        tracer.enable(sample_rate=2)
+        for _ in range(5):
+            outer_function()
+
+        results = tracer.disable()
+        print(tracer.format_results())
+        assert sys.getprofile() is None
+        results_by_mode[accelerate] = (
+            {func: (stats.call_count, stats.timed_count, stats.exception_count)
+             for func, stats in results.items()},
+            {key: edge.call_count for key, edge in tracer.get_call_graph().items()},
+            {path: node.call_count for path, node in tracer.iter_call_paths()},
+        )
+
+        assert results[slow_function].total_time >= 0.01
+        assert results[time.sleep].call_count == 9
+        assert tracer._local.stack == []
+
+    assert results_by_mode[True] == results_by_mode[False]
+    assert results_by_mode[True][0][fast_function] == (19, 12, 0)
+    assert results_by_mode[True][0][flaky_function] == (8, 8, 4)
+
+
 def main():
     """Run all tests."""
     print("=== Enhanced Function Tracer Tests ===")
@@ -146,6 +1174,27 @@ def main():
     test_decorator_approach()
     test_mixed_tracing()
     test_dynamic_toggling()
+    test_engines()
+    test_profile_engine_builtins()
+    test_timed_decorator()
+    test_multithreaded_tracing()
+    test_thread_stats_shards()
+    test_latency_percentiles()
+    test_quantile_sketch()
+    test_sampling()
+    test_overhead_governor()
+    test_overhead_calibration()
+    test_self_time()
+    test_call_graph()
+    test_call_paths()
+    test_flame_graph_export()
+    test_chrome_trace_export()
+    test_event_log()
+    test_generator_and_coroutine_timing()
+    test_asyncio_tasks()
+    test_exception_timing()
+    test_recursion_and_stale_entries()
+    test_native_profile_hook()
 
     print("\n=== All tests completed ===")
 